@@ -0,0 +1,206 @@
+"""
+Approximate nearest-neighbour search over TinyImages.
+
+The index is an inverted file with product-quantized residuals (IVF-PQ):
+every vector is assigned to the nearest of +nlist+ coarse centroids, and
+its residual from that centroid is compressed to +m+ bytes, one code per
+subspace. A query only scans the inverted lists of the +nprobe+ centroids
+nearest to it, ranking their entries with per-subspace distance tables.
+
+Building streams over the parts one at a time, writing one encoded part
+file per part, and then merges them into memory-mapped inverted lists, so
+memory stays bounded by the size of a part.
+"""
+
+import os
+import numpy
+from cachedindex import CachedIndex
+from features import FeatureStore, KINDS
+from parts import read_part
+
+def part_vectors(dataset, kind, block):
+  """
+  Returns the vectors of part +block+ as a (images, dimension) float32
+  array: raw pixels for "pixels", or a feature kind such as "gist".
+  """
+
+  if kind == 'pixels':
+    return read_part(dataset.cache, dataset.bucketname, block).astype(
+             numpy.float32)
+
+  store = FeatureStore(dataset, kind)
+  store.ensure([block])
+  return numpy.asarray(store.part(block))
+
+def nearest(data, centroids, batch_size = 4096):
+  """
+  Returns the index of the nearest centroid for each row of +data+.
+  """
+
+  norms = (centroids ** 2).sum(axis=1)
+  o = numpy.empty(len(data), dtype=numpy.int32)
+  for start in xrange(0, len(data), batch_size):
+    chunk = data[start:start + batch_size]
+    o[start:start + batch_size] = (
+      norms - 2 * chunk.dot(centroids.T)).argmin(axis=1)
+  return o
+
+def kmeans(data, k, iterations, random):
+  """
+  Clusters the rows of +data+ into +k+ centroids with Lloyd's algorithm.
+  """
+
+  centroids = data[random.choice(len(data), k, replace=k > len(data))].copy()
+  for i in xrange(iterations):
+    assignment = nearest(data, centroids)
+    order = numpy.argsort(assignment, kind='mergesort')
+    ordered = assignment[order]
+    starts = numpy.flatnonzero(
+               numpy.append([True], ordered[1:] != ordered[:-1]))
+
+    # Empty clusters keep their previous centroid.
+    labels = ordered[starts]
+    counts = numpy.diff(numpy.append(starts, len(ordered)))
+    sums = numpy.add.reduceat(data[order], starts, axis=0)
+    centroids[labels] = sums / counts[:, None]
+  return centroids
+
+class IVFPQIndex(CachedIndex):
+  """
+  An IVF-PQ index stored as a directory in the cache.
+  """
+
+  def __init__(self, dataset, kind):
+    CachedIndex.__init__(self, dataset, 'ann-{}'.format(kind),
+                         '{} index'.format(kind))
+    self.kind = kind
+
+  def encode(self, residuals, codebooks):
+    """
+    Returns the (N, m) uint8 PQ codes of the given residuals.
+    """
+
+    m, _, width = codebooks.shape
+    codes = numpy.empty((len(residuals), m), dtype=numpy.uint8)
+    for j in xrange(m):
+      codes[:, j] = nearest(residuals[:, j * width:(j + 1) * width],
+                            codebooks[j])
+    return codes
+
+  def build(self, blocks, nlist = 1024, m = 16, train_blocks = 8,
+            train_size = 50000, iterations = 10, seed = 0):
+    """
+    Trains the quantizers on a sample of the given parts, then encodes all
+    of them and writes the inverted lists.
+    """
+
+    random = numpy.random.RandomState(seed)
+    blocks = sorted(blocks)
+
+    if self.kind != 'pixels':
+      # Compute any missing features in parallel up front.
+      FeatureStore(self.dataset, self.kind).ensure(blocks)
+
+    # Train on a sample drawn from a few random parts.
+    sample = numpy.concatenate([part_vectors(self.dataset, self.kind, block)
+      for block in random.choice(blocks, min(train_blocks, len(blocks)),
+                                 replace=False)])
+    sample = sample[random.permutation(len(sample))[:train_size]]
+
+    dimension = sample.shape[1]
+    if dimension % m:
+      raise ValueError("The dimension {} is not a multiple of m={}".format(
+        dimension, m))
+    width = dimension // m
+
+    coarse = kmeans(sample, nlist, iterations, random)
+    residuals = sample - coarse[nearest(sample, coarse)]
+    codebooks = numpy.array([kmeans(residuals[:, j * width:(j + 1) * width],
+                                    256, iterations, random)
+                             for j in xrange(m)])
+    sample = residuals = None
+
+    with self.building('.ann') as work:
+      # Encode one part at a time.
+      counts = numpy.zeros(nlist, dtype=numpy.int64)
+      for block in blocks:
+        vectors = part_vectors(self.dataset, self.kind, block)
+        lists = nearest(vectors, coarse)
+        codes = self.encode(vectors - coarse[lists], codebooks)
+        ids = numpy.arange(len(vectors), dtype=numpy.int64) + block * 3400
+        numpy.savez(os.path.join(work, '{}.part.npz'.format(block)),
+                    ids=ids, lists=lists, codes=codes)
+        counts += numpy.bincount(lists, minlength=nlist)
+
+      # Merge the parts into inverted lists.
+      offsets = numpy.append([0], numpy.cumsum(counts))
+      total = max(offsets[-1], 1)
+      all_ids = numpy.memmap(os.path.join(work, 'lists.ids'),
+                  dtype=numpy.int64, mode='w+', shape=(total,))
+      all_codes = numpy.memmap(os.path.join(work, 'lists.codes'),
+                    dtype=numpy.uint8, mode='w+', shape=(total, m))
+
+      cursor = offsets[:-1].copy()
+      for block in blocks:
+        part = numpy.load(os.path.join(work, '{}.part.npz'.format(block)))
+        lists = part['lists']
+        order = numpy.argsort(lists, kind='mergesort')
+        sorted_lists = lists[order]
+        starts = numpy.searchsorted(sorted_lists, sorted_lists)
+        positions = cursor[sorted_lists] + numpy.arange(len(order)) - starts
+        all_ids[positions] = part['ids'][order]
+        all_codes[positions] = part['codes'][order]
+        cursor += numpy.bincount(lists, minlength=nlist)
+
+      all_ids.flush()
+      all_codes.flush()
+      del all_ids, all_codes
+
+      numpy.savez(os.path.join(work, 'model.npz'), coarse=coarse,
+                  codebooks=codebooks, offsets=offsets)
+
+  def read(self):
+    model = numpy.load(os.path.join(self.path, 'model.npz'))
+    m = model['codebooks'].shape[0]
+    return (model['coarse'], model['codebooks'], model['offsets'],
+      numpy.memmap(os.path.join(self.path, 'lists.ids'),
+                   dtype=numpy.int64, mode='r'),
+      numpy.memmap(os.path.join(self.path, 'lists.codes'),
+                   dtype=numpy.uint8, mode='r').reshape(-1, m))
+
+  def search(self, query, k, nprobe = 8):
+    """
+    Returns the ids of the (approximately) +k+ nearest vectors to +query+
+    and their estimated squared distances, nearest first.
+    """
+
+    coarse, codebooks, offsets, all_ids, all_codes = self.load()
+    m, _, width = codebooks.shape
+    query = numpy.asarray(query, dtype=numpy.float32).ravel()
+
+    probes = ((coarse - query) ** 2).sum(axis=1).argsort()[:nprobe]
+    columns = numpy.arange(m) * 256
+
+    ids, distances = [], []
+    for l in probes:
+      first, last = offsets[l], offsets[l + 1]
+      if first == last:
+        continue
+
+      # Distances from the residual to every codeword, per subspace.
+      residual = (query - coarse[l]).reshape(m, 1, width)
+      table = ((codebooks - residual) ** 2).sum(axis=2).ravel()
+
+      codes = numpy.asarray(all_codes[first:last], dtype=numpy.intp)
+      ids.append(all_ids[first:last])
+      distances.append(table[codes + columns].sum(axis=1))
+
+    if not ids:
+      return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+
+    ids = numpy.concatenate(ids)
+    distances = numpy.concatenate(distances)
+    top = distances.argsort()[:k] if len(ids) <= k else \
+          distances.argpartition(k)[:k]
+    top = top[distances[top].argsort()]
+    return ids[top], distances[top]
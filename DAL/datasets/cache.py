@@ -1,23 +1,66 @@
 import config
 import pickle 
+import re
 import os
 import os.path
 import subprocess
 import fcntl
 import time
-from boto.s3.connection import S3Connection, OrdinaryCallingFormat
-from boto.s3.key import Key
+import threading
 import czipfile as zipfile
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, namedtuple
 import os
 import errno
+import json
 from httplib import IncompleteRead
 import tempfile
 import shutil
+import calendar
+import zlib
+from transfer import RangedDownload, get_range
+from sparse import SparseFile
+import numpy
+import lineindex
+import memo
+import columns
+import connections
 
-#TODO - size handling
-def parseSize(s):
-  pass
+SIZE_UNITS = {'': 1, 'B': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30,
+              'T': 1 << 40}
+
+# Bookkeeping files that live in the cache directory but are never evicted.
+RESERVED = ('cache.log', 'cache.index')
+
+# Files derived from a cached file, named by appending one of these suffixes.
+# They are not tracked on their own and are evicted along with their file.
+SIDECARS = ('.bitmap', '.offsets', '.columns')
+
+# Number of lock files that downloads are spread over.
+LOCK_SLOTS = 256
+
+def is_sidecar(name):
+  return name.endswith(SIDECARS)
+
+def parseSize(s, total=None):
+  """
+  Converts a size such as "20GB", "512M" or "80%" into a number of bytes.
+  Percentages are taken relative to +total+. Returns None when +s+ does not
+  describe a size (e.g. "unused"), in which case no budget is enforced.
+  """
+
+  if isinstance(s, (int, long)):
+    return s
+
+  match = re.match(r'^\s*([0-9.]+)\s*(%|[BKMGT]?)B?\s*$', str(s).upper())
+  if match is None:
+    return None
+
+  amount, unit = float(match.group(1)), match.group(2)
+  if unit == '%':
+    if total is None:
+      return None
+    return int(total * amount / 100)
+  return int(amount * SIZE_UNITS[unit])
 
 def decompress_name(name):
   pieces = name.split('.')
@@ -25,12 +68,294 @@ def decompress_name(name):
 
 def storage_name(path, name, bucketname):
   return path+'/' + bucketname+'-'.join(name.split('/'))
- 
+
+# One object of a cached bucket listing.
+ListingEntry = namedtuple('ListingEntry', 'key size etag last_modified')
+
+def parse_timestamp(value):
+  """
+  Converts an S3 timestamp such as "2013-01-01T12:00:00.000Z" to seconds
+  since the epoch.
+  """
+
+  return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+class ZipStream(object):
+  """
+  A read-only handle on the first member of a zip archive, inflated lazily
+  as it is read. Iterating over it yields lines, like a file.
+  """
+
+  def __init__(self, path, chunk_size = 1 << 20):
+    self.archive = zipfile.ZipFile(path)
+    self.member = self.archive.open(self.archive.namelist()[0])
+    self.name = path
+    self.chunk_size = chunk_size
+
+  def read(self, size = -1):
+    return self.member.read(size)
+
+  def __iter__(self):
+    # Splitting large chunks is much faster than the member's readline().
+    rest = ''
+    while True:
+      chunk = self.member.read(self.chunk_size)
+      if not chunk:
+        break
+
+      lines = (rest + chunk).split('\n')
+      rest = lines.pop()
+      for line in lines:
+        yield line + '\n'
+
+    if rest:
+      yield rest
+
+  def close(self):
+    self.member.close()
+    self.archive.close()
+
+class LRUIndex(object):
+  """
+  Keeps the files of a cache directory in least-recently-used order along
+  with their sizes. Every change is appended to a journal, so the index
+  survives restarts and picks up files added by other processes sharing the
+  same directory.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.journal = os.path.join(path, 'cache.index')
+    self.entries = OrderedDict()
+    self.total = 0
+    self.position = 0
+    self.inode = None
+    self.lines = 0
+    self.lock = threading.RLock()
+
+    if not os.path.exists(self.journal):
+      self.__seed()
+    self.sync()
+
+  def __seed(self):
+    """
+    Builds the journal from the files already present in the cache, oldest
+    first, so that caches created before the index existed are accounted for.
+    """
+
+    files = []
+    for name in os.listdir(self.path):
+      if name in RESERVED or name.startswith('.') or is_sidecar(name):
+        continue
+      fullpath = os.path.join(self.path, name)
+      files.append((os.path.getmtime(fullpath), name, footprint(fullpath)))
+
+    self.__write([('touch', name, size) for _, name, size in sorted(files)])
+
+  def __open(self):
+    """
+    Returns the journal opened for appending and locked against other
+    processes. Retries if the journal is replaced by a compaction while
+    waiting for the lock, so that no entry goes to the old file.
+    """
+
+    while True:
+      journal = open(self.journal, 'a')
+      fcntl.flock(journal, fcntl.LOCK_EX)
+      try:
+        if os.fstat(journal.fileno()).st_ino == os.stat(self.journal).st_ino:
+          return journal
+      except OSError:
+        pass
+      journal.close()
+
+  def __write(self, entries):
+    journal = self.__open()
+    try:
+      journal.write(''.join(json.dumps(e) + '\n' for e in entries))
+    finally:
+      journal.close()
+
+  def __apply(self, op, name, size=None):
+    old = self.entries.pop(name, None)
+    if old is not None:
+      self.total -= old
+    if op == 'touch':
+      self.entries[name] = size
+      self.total += size
+    self.lines += 1
+
+  def sync(self):
+    """
+    Applies the journal entries written since the last call, including the
+    ones written by other processes.
+    """
+
+    with self.lock:
+      try:
+        journal = open(self.journal)
+      except IOError:
+        return
+
+      inode = os.fstat(journal.fileno()).st_ino
+      if inode != self.inode:
+        # The journal was compacted; start over from the new file.
+        self.entries = OrderedDict()
+        self.total = 0
+        self.position = 0
+        self.lines = 0
+        self.inode = inode
+
+      journal.seek(self.position)
+      for line in journal:
+        if not line.endswith('\n'):
+          break # partially written entry
+        try:
+          self.__apply(*json.loads(line))
+        except (ValueError, TypeError):
+          pass
+        self.position += len(line)
+      journal.close()
+
+  def touch(self, name, size=None):
+    """
+    Marks +name+ as the most recently used file, recording its size if it is
+    new to the index.
+    """
+
+    with self.lock:
+      if size is None:
+        if name in self.entries and next(reversed(self.entries)) == name:
+          return # already the most recent entry
+        size = self.entries.get(name)
+        if size is None:
+          if not os.path.exists(os.path.join(self.path, name)):
+            return # evicted in the meantime
+          size = footprint(os.path.join(self.path, name))
+
+      self.__apply('touch', name, size)
+      self.__write([('touch', name, size)])
+
+      if self.bloated():
+        self.compact()
+
+  def remove(self, name):
+    """
+    Forgets about +name+.
+    """
+
+    with self.lock:
+      if name in self.entries:
+        self.__apply('remove', name)
+        self.__write([('remove', name)])
+
+  def oldest(self, exclude=()):
+    """
+    Returns the name of the least recently used file that is not in
+    +exclude+, or None.
+    """
+
+    with self.lock:
+      for name in self.entries:
+        if name not in exclude:
+          return name
+      return None
+
+  def bloated(self):
+    """
+    Returns true if the journal holds many more lines than live entries.
+    """
+
+    return self.lines > 2 * len(self.entries) + 1000
+
+  def compact(self):
+    """
+    Rewrites the journal so that it only holds the live entries.
+    """
+
+    with self.lock:
+      lock = self.__open()
+      try:
+        self.sync()
+        handle, temp = tempfile.mkstemp(dir=self.path, prefix='.cache.index')
+        os.write(handle, ''.join(json.dumps(('touch', name, size)) + '\n'
+                                 for name, size in self.entries.items()))
+        os.close(handle)
+        os.rename(temp, self.journal)
+        self.sync()
+      finally:
+        lock.close()
+
+_indexes = {}
+
+# Bucket listings loaded by this process, by path: (mtime, entries, by key).
+_listings = {}
+
+# Memory-mapped files of this process, by path: (mtime, array). Only the
+# most recently used ones are kept open.
+_mmaps = OrderedDict()
+MAX_MMAPS = 256
+
+# Line-offset indexes loaded by this process, by path: (mtime, offsets).
+_offsets = {}
+
+# Sparse objects loaded by this process, by path.
+_sparse = {}
+
+# Files this process is about to read, by cache directory: {name: count}.
+# The garbage collector leaves them alone.
+_pinned = defaultdict(lambda: defaultdict(int))
+_pinning = threading.Lock()
+
+def lru_index(path):
+  """
+  Returns the LRUIndex for the given cache directory, shared by every Cache
+  in this process.
+  """
+
+  path = os.path.abspath(path)
+  if path not in _indexes:
+    _indexes[path] = LRUIndex(path)
+  return _indexes[path]
+
+def disk_usage(path):
+  """
+  Returns the number of bytes used by the file or directory at +path+.
+  """
+
+  if not os.path.isdir(path):
+    return os.path.getsize(path)
+
+  total = 0
+  for root, _, names in os.walk(path):
+    for name in names:
+      total += os.path.getsize(os.path.join(root, name))
+  return total
+
+def footprint(path):
+  """
+  Returns the number of bytes used by the cached file at +path+ together
+  with its sidecars, which are evicted with it.
+  """
+
+  total = disk_usage(path)
+  for suffix in SIDECARS:
+    if os.path.exists(path + suffix):
+      total += disk_usage(path + suffix)
+  return total
+
+def filesystem_size(path):
+  """
+  Returns the total size in bytes of the filesystem holding +path+.
+  """
+
+  stats = os.statvfs(path)
+  return stats.f_blocks * stats.f_frsize
+
 class Cache:
   def __init__(self):
     self.config = config.config()
     self.path = self.config['cache']['path']
-    self.size = parseSize(self.config['cache']['size'])
     
     try:
       os.makedirs(self.path)
@@ -40,41 +365,191 @@ class Cache:
       else:
         raise
 
+    self.size = parseSize(self.config['cache'].get('size'),
+                          total=filesystem_size(self.path))
+    self.index = lru_index(self.path)
+
+    # Objects larger than one chunk are fetched as parallel byte ranges.
+    self.chunk_size = parseSize(self.config['cache'].get('chunk_size', '16MB'))
+    self.concurrency = int(self.config['cache'].get('concurrency', 8))
+
+    # Bucket listings are reused for this many seconds.
+    self.listing_ttl = float(self.config['cache'].get('listing_ttl', 3600))
+
+    # Sparse objects are downloaded in full once this fraction is present.
+    self.sparse_threshold = float(
+      self.config['cache'].get('sparse_threshold', 0.5))
+
+    # Iterating over several subsets fetches up to this many ahead, as long
+    # as they add up to at most prefetch_size bytes (if the cache has a size).
+    self.prefetch = int(self.config['cache'].get('prefetch', 2))
+    self.prefetch_size = parseSize(
+      self.config['cache'].get('prefetch_size', '25%'), total=self.size)
+
+    # Parsed side files are kept in memory up to this size.
+    self.memo = memo.memo(self.path,
+      parseSize(self.config['cache'].get('memo_size', '256MB')))
+
   def connect(self):
-    return S3Connection(
+    """
+    Returns this thread's pooled S3 connection.
+    """
+
+    return connections.connection(
+      aws_access_key_id = self.config.get('aws_access_key_id'),
+      aws_secret_access_key = self.config.get('aws_secret_access_key'),
+    )
+
+  def bucket(self, bucketname, validate = True):
+    """
+    Returns this thread's pooled bucket object for +bucketname+.
+    """
+
+    return connections.bucket(bucketname, validate,
       aws_access_key_id = self.config.get('aws_access_key_id'),
       aws_secret_access_key = self.config.get('aws_secret_access_key'),
-      calling_format = OrdinaryCallingFormat(),
     )
 
-  def s3listcontents(self, bucketname):
-    conn = self.connect()
-    b = conn.get_bucket(bucketname)
-    o = b.list()
-    conn.close()
-    return o
+  def s3listcontents(self, bucketname, refresh = False):
+    """
+    Returns the ListingEntry of every object in the given bucket. Listings
+    are cached on disk and only fetched again once they are older than
+    cache.listing_ttl seconds, or when +refresh+ is set.
+    """
+
+    path = os.path.join(self.path, '.listing-' + bucketname + '.json')
+
+    try:
+      mtime = os.path.getmtime(path)
+    except OSError:
+      mtime = None
+
+    if refresh or mtime is None or time.time() - mtime > self.listing_ttl:
+      self.refreshlisting(bucketname)
+    elif _listings.get(path, (None,))[0] != mtime:
+      f = open(path)
+      try:
+        entries = [ListingEntry(*e) for e in json.load(f)]
+      finally:
+        f.close()
+      _listings[path] = (mtime, entries, dict((e.key, e) for e in entries))
+    return _listings[path][1]
+
+  def refreshlisting(self, bucketname):
+    """
+    Fetches the listing of the given bucket from S3 and caches it.
+    """
+
+    entries = [ListingEntry(k.key, k.size, k.etag.strip('"'),
+                            parse_timestamp(k.last_modified))
+               for k in self.bucket(bucketname).list()]
+
+    path = os.path.join(self.path, '.listing-' + bucketname + '.json')
+    handle, temp = tempfile.mkstemp(dir=self.path, prefix='.listing')
+    os.write(handle, json.dumps(entries))
+    os.close(handle)
+    os.rename(temp, path)
+
+    _listings[path] = (os.path.getmtime(path), entries,
+                       dict((e.key, e) for e in entries))
+    return entries
+
+  def isfresh(self, bucketname, objname):
+    """
+    Returns true if the cached copy of the given object is at least as new
+    as the object in the cached bucket listing, and has the listed size.
+    Returns None if the object is not cached or not listed. No request is
+    made unless the listing itself has expired.
+    """
+
+    path = storage_name(self.path, objname, bucketname)
+    if not os.path.isfile(path):
+      return None
+
+    entry = self.s3entry(bucketname, objname)
+    if entry is None:
+      return None
+    return (os.path.getsize(path) == entry.size and
+            os.path.getmtime(path) >= entry.last_modified)
+
+  def s3entry(self, bucketname, objname):
+    """
+    Returns the ListingEntry of the given object from the cached bucket
+    listing, or None if it is not listed.
+    """
+
+    self.s3listcontents(bucketname)
+    path = os.path.join(self.path, '.listing-' + bucketname + '.json')
+    return _listings[path][2].get(objname)
   
   def s3tocache(self, bucketname, objname, decompress=None):
-    conn = self.connect()
-    b = conn.get_bucket(bucketname)
-    k = Key(b)
-    k.key = objname
+    """
+    Downloads the given object into the cache. Only one process per cache
+    directory fetches a given object; the others wait for it to finish and
+    reuse its result.
+    """
+
     path = storage_name(self.path, objname, bucketname)
-    
-    for i in xrange(5):
-        try:
-            k.get_contents_to_filename(path)
-        except IncompleteRead:
-            k.close(fast = True)
-            time.sleep(1)
+
+    lock = self.__lockOrNone(bucketname, objname)
+    if lock is None:
+      # Someone else is downloading this object; wait for them.
+      self.__logWithLock(bucketname, objname, "WAITING")
+      lock = self.__lockOrNone(bucketname, objname, blocking=True)
+
+    try:
+      if self.__getStateFromLog(bucketname, objname, decompress) == "COMPLETE":
+        return
+
+      if not os.path.isfile(path):
+        self.__logWithLock(bucketname, objname, "DOWNLOADING")
+        self.__download(bucketname, objname, path)
+        self.record(path)
+
+      if decompress is not None:
+        self.record(self.decompress(decompress, path))
+
+      self.__logWithLock(bucketname, objname, "COMPLETE")
+    finally:
+      lock.close()
+
+  def __download(self, bucketname, objname, path):
+    """
+    Fetches the object into a temporary file, then atomically moves it to
+    +path+ so that readers never see a partially written file.
+    """
+
+    k = self.bucket(bucketname).get_key(objname)
+    if k is None:
+      raise KeyError("No such object: {}/{}".format(bucketname, objname))
+
+    handle, temp = tempfile.mkstemp(dir=self.path,
+                                    prefix='.' + os.path.basename(path))
+    os.close(handle)
+
+    try:
+      if self.chunk_size and k.size > self.chunk_size:
+        RangedDownload(lambda: self.bucket(bucketname, validate = False),
+                       objname, temp, k.size, self.chunk_size,
+                       self.concurrency).run()
+
+      else:
+        for i in xrange(5):
+            try:
+                k.get_contents_to_filename(temp)
+            except IncompleteRead:
+                k.close(fast = True)
+                time.sleep(1)
+            else:
+                break
         else:
-            break
-    else:
-        k.get_contents_to_filename(path)
-    
-    if decompress is not None:
-      self.decompress(decompress, path) 
-       
+            k.get_contents_to_filename(temp)
+
+      os.rename(temp, path)
+    finally:
+      if os.path.exists(temp):
+        os.remove(temp)
+
   def decompress(self, algorithm, zip_file_path):
     """
     Uses the given algorithm to decompress +path+ to
@@ -85,7 +560,7 @@ class Cache:
     
     if not os.path.isfile(resulting_path):
       if algorithm == 'unzip':
-        extraction_directory = self.path + "/" + str(time.time())
+        extraction_directory = tempfile.mkdtemp(dir=self.path, prefix='.')
         
         try:
           archive = zipfile.ZipFile(zip_file_path)
@@ -107,75 +582,376 @@ class Cache:
     
     return resulting_path
   
-  def run_gc(self, target_ratio = 0.30):
+  def record(self, path):
     """
-    Attempts to clear the files in /tmp up to the given availability level.
+    Adds the freshly written file at +path+ to the cache index as the most
+    recently used one. Its size includes the sidecars written so far, so
+    this is called again when a sidecar is added.
     """
 
-    # Get rid of old files first.
-    files = [(os.path.getmtime(os.path.join(self.path, x)), x)
-               for x in os.listdir(self.path)]
+    self.index.touch(os.path.basename(path), footprint(path))
 
-    for _, filename in sorted(files):
-      fullpath = os.path.join(self.path, filename)
+  def evict(self, name):
+    """
+    Removes +name+ from the cache.
+    """
+
+    for suffix in ('',) + SIDECARS:
+      fullpath = os.path.join(self.path, name + suffix)
+      try:
+        if os.path.isdir(fullpath):
+          shutil.rmtree(fullpath)
+        else:
+          os.remove(fullpath)
+      except OSError as exc:
+        if exc.errno != errno.ENOENT:
+          raise
+    _sparse.pop(os.path.join(self.path, name), None)
+    self.index.remove(name)
+
+  def over_budget(self, target_ratio = 0.30):
+    """
+    Returns true if the cache holds more than its configured size. Without a
+    configured size, the cache is over budget while less than +target_ratio+
+    of the filesystem is free.
+    """
+
+    if self.size is not None:
+      return self.index.total > self.size
 
-      # Compute the file usage ratio.
-      stats = os.statvfs(fullpath)
-      ratio = float(stats.f_bavail) / stats.f_blocks
+    stats = os.statvfs(self.path)
+    return float(stats.f_bavail) / stats.f_blocks <= target_ratio
 
-      if ratio > target_ratio:
+  def run_gc(self, keep = None):
+    """
+    Evicts the least recently used files until the cache fits its budget.
+    The file named +keep+ and pinned files are never evicted.
+    """
+
+    self.index.sync()
+
+    with _pinning:
+      exclude = set(_pinned[os.path.abspath(self.path)])
+    if keep is not None:
+      exclude.add(keep)
+
+    while self.over_budget():
+      name = self.index.oldest(exclude)
+      if name is None:
         break
+      self.evict(name)
 
-      # Clear this file.
-      if os.path.isfile(fullpath):
-        os.remove(fullpath)
-      else:
-        shutil.rmtree(fullpath)
+    if self.index.bloated():
+      self.index.compact()
+
+  def pin(self, name):
+    """
+    Keeps +name+ from being evicted by this process until it is unpinned.
+    """
+
+    with _pinning:
+      _pinned[os.path.abspath(self.path)][name] += 1
+
+  def unpin(self, name):
+    with _pinning:
+      pins = _pinned[os.path.abspath(self.path)]
+      pins[name] -= 1
+      if pins[name] <= 0:
+        del pins[name]
 
   def cleancache(self):
     """
     Removes all files from the cache.
     """
 
-    self.run_gc(1.0)
+    for name in os.listdir(self.path):
+      if name != 'cache.index':
+        self.evict(name)
+
+    self.index.compact()
 
-  def directhandle(self, bucketname, objname, decompress=None, binary=None):
+  def directhandle(self, bucketname, objname, decompress=None, binary=None,
+                   stream=None):
     """
-    Downloads the given file from the S3 bucket.
+    Downloads the given file from the S3 bucket. With +stream+ set, an
+    archive is not extracted to disk; the returned handle inflates it while
+    it is being read instead. This only suits sequential reads.
     """
 
-    # Ensure that we have space to download the given file.
-    self.run_gc()
-
     # Downloads the file.
     if decompress is None:
       path = storage_name(self.path, objname, bucketname)
     else:
       path = decompress_name(storage_name(self.path, objname, bucketname))
     if os.path.isfile(path):
-      if binary is not None:
-        return open(path, 'rb')
-      else:
-        return open(path)
+      self.index.touch(os.path.basename(path))
+    elif decompress is not None and stream:
+      return self.streamhandle(bucketname, objname, decompress)
     else:
       self.s3tocache(bucketname, objname, decompress=decompress)
-      if binary is not None:
-        return open(path, 'rb')
-      else:
-        return open(path)
+
+      # Ensure that the cache stays within its budget.
+      self.run_gc(keep = os.path.basename(path))
+
+    if binary is not None:
+      return open(path, 'rb')
+    else:
+      return open(path)
+
+  def streamhandle(self, bucketname, objname, algorithm):
+    """
+    Returns a ZipStream over the first member of the given archive, which is
+    downloaded but not extracted.
+    """
+
+    if algorithm != 'unzip':
+      raise ValueError("Unknown decompression algorithm: {!r}".
+         format(algorithm))
+
+    path = storage_name(self.path, objname, bucketname)
+    if os.path.isfile(path):
+      self.index.touch(os.path.basename(path))
+    else:
+      self.s3tocache(bucketname, objname)
+      self.run_gc(keep = os.path.basename(path))
+
+    return ZipStream(path)
   
-  def __getStateFromLog(self, bucketname, objname):
-    filename = bucketname + "-" + objname
-    if os.path.exists(os.path.join(self.path, filename)):
+  def mmaphandle(self, bucketname, objname, decompress=None):
+    """
+    Returns the given file from the S3 bucket as a read-only uint8
+    numpy.memmap, downloading it if needed.
+    """
+
+    if decompress is None:
+      path = storage_name(self.path, objname, bucketname)
+    else:
+      path = decompress_name(storage_name(self.path, objname, bucketname))
+    self.directhandle(bucketname, objname, decompress=decompress).close()
+
+    mtime = os.path.getmtime(path)
+    cached = _mmaps.pop(path, None)
+    if cached is None or cached[0] != mtime:
+      if os.path.getsize(path) == 0:
+        cached = (mtime, numpy.zeros(0, dtype=numpy.uint8))
+      else:
+        cached = (mtime, numpy.memmap(path, dtype=numpy.uint8, mode='r'))
+
+    _mmaps[path] = cached
+    while len(_mmaps) > MAX_MMAPS:
+      _mmaps.popitem(last=False)
+    return cached[1]
+
+  def lineindex(self, bucketname, objname, decompress=None, build=True):
+    """
+    Returns the offsets of the non-blank lines of the given object as a
+    uint64 array. The index is built the first time it is needed and kept
+    next to the cached file; with +build+ false, None is returned instead
+    (also when the file itself is not cached).
+    """
+
+    if decompress is None:
+      path = storage_name(self.path, objname, bucketname)
+    else:
+      path = decompress_name(storage_name(self.path, objname, bucketname))
+    if not os.path.isfile(path):
+      if not build:
+        return None
+      self.directhandle(bucketname, objname, decompress=decompress).close()
+
+    mtime = os.path.getmtime(path)
+    if _offsets.get(path, (None,))[0] != mtime:
+      offsets = lineindex.load(path)
+      if offsets is None:
+        if not build:
+          return None
+        offsets = lineindex.build(path)
+        self.record(path)
+        self.run_gc(keep = os.path.basename(path))
+      _offsets[path] = (mtime, offsets)
+    return _offsets[path][1]
+
+  def columns(self, bucketname, objname, fields, records):
+    """
+    Returns a dictionary mapping each of +fields+ to its memory-mapped
+    column for the given object, converting the fields that have no
+    up-to-date column first. Calling +records+ must return an iterator over
+    the parsed records of the object.
+    """
+
+    path = storage_name(self.path, objname, bucketname)
+    if os.path.isfile(path):
+      self.index.touch(os.path.basename(path))
+    else:
+      self.directhandle(bucketname, objname).close()
+
+    missing = [field for field in fields if columns.load(path, field) is None]
+    if missing:
+      columns.build(path, missing, records)
+      self.record(path)
+      self.run_gc(keep = os.path.basename(path))
+
+    return dict((field, columns.load(path, field)) for field in fields)
+
+  def sidefile(self, bucketname, objname, key, loader, decompress=None,
+               binary=None):
+    """
+    Returns +loader+ applied to a handle on the given object. The result is
+    memoized under +key+ until the cached file changes, so each process
+    parses a side file only once; it is shared, and must not be modified.
+    """
+
+    if decompress is None:
+      path = storage_name(self.path, objname, bucketname)
+    else:
+      path = decompress_name(storage_name(self.path, objname, bucketname))
+
+    def load():
+      f = self.directhandle(bucketname, objname, decompress=decompress,
+                            binary=binary)
+      try:
+        return loader(f)
+      finally:
+        f.close()
+
+    # Keep the file recently used while it is read from memory, so that the
+    # most used side files are not the first ones evicted.
+    return self.memo.get(path, key, load,
+                         lambda: self.index.touch(os.path.basename(path)))
+
+  def directrange(self, bucketname, objname, spans, block_size):
+    """
+    Returns the contents of each (offset, length) span of the given object
+    without downloading all of it. Missing spans are fetched with S3 Range
+    GETs, rounded out to multiples of +block_size+, and kept in a sparse
+    local file. Once most of the object is present, it is downloaded in
+    full and served from the regular cache file.
+    """
+
+    path = storage_name(self.path, objname, bucketname)
+
+    if os.path.isfile(path):
+      self.index.touch(os.path.basename(path))
+      return self.__readspans(path, spans)
+
+    # Serve from the sparse copy if everything needed is already there.
+    sparse = _sparse.get(path + '.sparse')
+    if sparse is not None and not sparse.current():
+      # Evicted or rewritten by another process; reload it under the lock.
+      _sparse.pop(sparse.path, None)
+    elif sparse is not None and not sparse.missing(spans):
+      try:
+        result = sparse.read(spans)
+      except IOError:
+        _sparse.pop(sparse.path, None) # evicted
+      else:
+        self.index.touch(os.path.basename(sparse.path))
+        return result
+
+    lock = self.__lockOrNone(bucketname, objname, blocking=True)
+    try:
+      if not os.path.isfile(path):
+        self.__fetchspans(bucketname, objname, path, spans, block_size)
+    finally:
+      lock.close()
+
+    if os.path.isfile(path):
+      self.run_gc(keep = os.path.basename(path))
+      return self.__readspans(path, spans)
+    else:
+      self.run_gc(keep = os.path.basename(path) + '.sparse')
+      return _sparse[path + '.sparse'].read(spans)
+
+  def __fetchspans(self, bucketname, objname, path, spans, block_size):
+    """
+    Makes sure the sparse copy of the given object covers +spans+, or
+    replaces it with a full download. Must be called with the object lock
+    held.
+    """
+
+    b = self.bucket(bucketname, validate = False)
+
+    sparse = SparseFile.load(path + '.sparse')
+    if sparse is None or sparse.block_size != block_size:
+      k = b.get_key(objname)
+      if k is None:
+        raise KeyError("No such object: {}/{}".format(bucketname, objname))
+      self.evict(os.path.basename(path) + '.sparse')
+      sparse = SparseFile(path + '.sparse', k.size, block_size)
+
+    ranges = sparse.missing(spans)
+    needed = sum(last - first + 1 for first, last in ranges)
+
+    if sparse.present * block_size + needed >= \
+         self.sparse_threshold * sparse.size:
+      # Most of the object is wanted anyway, so fetch all of it.
+      self.__download(bucketname, objname, path)
+      self.record(path)
+      self.evict(os.path.basename(sparse.path))
+      _sparse.pop(sparse.path, None)
+      return
+
+    for first, last in ranges:
+      sparse.write(first, get_range(b, objname, first, last))
+    sparse.save()
+
+    _sparse[sparse.path] = sparse
+    self.index.touch(os.path.basename(sparse.path),
+                     min(sparse.present * block_size, sparse.size))
+
+  def __readspans(self, path, spans):
+    f = open(path, 'rb')
+    try:
+      result = []
+      for offset, length in spans:
+        f.seek(offset)
+        result.append(f.read(length))
+      return result
+    finally:
+      f.close()
+
+  def __getStateFromLog(self, bucketname, objname, decompress=None):
+    path = storage_name(self.path, objname, bucketname)
+    if decompress is not None:
+      path = decompress_name(path)
+    if os.path.isfile(path):
       return "COMPLETE"
     else:
-      return NONE
+      return None
    
-  def __lockOrNone(self, bucketname, obj):
-    return None
+  def __lockOrNone(self, bucketname, objname, blocking=False):
+    """
+    Takes the download lock of the object, returning a handle that releases
+    it when closed. Returns None if another process holds the lock, unless
+    +blocking+ is set, in which case this waits for it. Objects share a fixed
+    set of LOCK_SLOTS lock files, so that no lock file is left behind per
+    object; objects that share a slot are simply downloaded one at a time.
+    """
+
+    name = os.path.basename(storage_name(self.path, objname, bucketname))
+    slot = (zlib.crc32(name) & 0xffffffff) % LOCK_SLOTS
+    lock = open(os.path.join(self.path, '.lock-{:03d}'.format(slot)), 'a')
+
+    try:
+      if blocking:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+      else:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as exc:
+      lock.close()
+      if exc.errno in (errno.EAGAIN, errno.EACCES):
+        return None
+      raise
+
+    return lock
 
   def __logWithLock(self, bucketname, objname, state):
-    pass
+    entrylog = open(self.path+'/cache.log', "a+")
+    try:
+      fcntl.flock(entrylog, fcntl.LOCK_EX)
+      entrylog.write("%s %s %s\n" % (bucketname, objname, state))
+    finally:
+      entrylog.close()
 
   def __log(self, bucketname, objname, state):
     entrylog = open(self.path+'/cache.log', "a+") 
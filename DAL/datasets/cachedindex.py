@@ -0,0 +1,70 @@
+"""
+Indexes stored as directories in the cache.
+
+An index is built in a temporary directory next to the cache files and
+published by renaming it into place, so readers never see a partial
+index. Once published it is an ordinary cache entry: it is recorded in the
+LRU index, touched whenever it is loaded, and may be evicted by garbage
+collection like any other file.
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from cache import storage_name
+
+class CachedIndex(object):
+  """
+  An index of +dataset+ stored in the cache as the directory +name+.
+  Subclasses implement read(), which loads the published index; +what+
+  names the index in error messages.
+  """
+
+  def __init__(self, dataset, name, what):
+    self.dataset = dataset
+    self.path = storage_name(dataset.cache.path, name, dataset.bucketname)
+    self.what = what
+    self.model = None
+
+  def exists(self):
+    return os.path.isfile(os.path.join(self.path, 'model.npz'))
+
+  @contextmanager
+  def building(self, prefix):
+    """
+    Yields a temporary directory to write the index into, which replaces
+    the published index if the block completes.
+    """
+
+    cache = self.dataset.cache
+    work = tempfile.mkdtemp(dir=cache.path, prefix=prefix)
+    try:
+      yield work
+      cache.evict(os.path.basename(self.path))
+      os.rename(work, self.path)
+    finally:
+      if os.path.isdir(work):
+        shutil.rmtree(work)
+
+    self.model = None
+    cache.record(self.path)
+
+  def read(self):
+    raise NotImplementedError
+
+  def load(self):
+    """
+    Returns the model read from the published index, reading it again if
+    the index was evicted and rebuilt since.
+    """
+
+    if not self.exists():
+      # Never built, or evicted since it was loaded.
+      self.model = None
+      raise ValueError("There is no {}; build it first.".format(self.what))
+
+    if self.model is None:
+      self.model = self.read()
+    self.dataset.cache.index.touch(os.path.basename(self.path))
+    return self.model
@@ -0,0 +1,240 @@
+"""
+Columnar copies of JSON-lines subsets.
+
+The requested fields of every record are written once to a ".columns"
+directory next to the cached subset, one set of files per field:
+
+  <field>.meta     the kind of the column, its length and the source file
+  <field>.values   numeric values as a flat numpy array, or
+  <field>.offsets  uint64 start offsets into <field>.bytes, for strings
+  <field>.missing  a bool per record, if some records lack the field
+
+Booleans, integers and floats become bool, int64 and float64 arrays.
+Strings are stored as UTF-8, and any other values (lists, objects, or a
+mix of types) as JSON text that is decoded when it is read. Columns are
+read back memory-mapped, so scanning a field costs no parsing.
+
+Converting takes two passes over the subset: the first finds the kind of
+each field and the number of records, and the second writes the values.
+"""
+
+import os
+import json
+import urllib
+import tempfile
+import shutil
+import numpy
+
+MISSING = object()
+
+DTYPES = {'bool': numpy.bool_, 'int': numpy.int64, 'float': numpy.float64}
+
+def lookup(record, field):
+  """
+  Returns the value of +field+ in +record+, where "a.b" names the field b of
+  the object in field a, or MISSING if there is no such (non-null) value.
+  """
+
+  for name in field.split('.'):
+    if not isinstance(record, dict) or name not in record:
+      return MISSING
+    record = record[name]
+  return MISSING if record is None else record
+
+def kind_of(value):
+  if isinstance(value, bool):
+    return 'bool'
+  if isinstance(value, (int, long)):
+    return 'int' if -2**63 <= value < 2**63 else 'json'
+  if isinstance(value, float):
+    return 'float'
+  if isinstance(value, basestring):
+    return 'string'
+  return 'json'
+
+def merge(a, b):
+  """
+  Returns the kind of a column holding values of kinds +a+ and +b+.
+  """
+
+  if a is None or a == b:
+    return b
+  if set((a, b)) == set(('int', 'float')):
+    return 'float'
+  return 'json'
+
+def column_name(path, field):
+  return os.path.join(path + '.columns', urllib.quote(field, safe=''))
+
+def source(path):
+  stats = os.stat(path)
+  return [stats.st_size, stats.st_mtime]
+
+class StringColumn(object):
+  """
+  A memory-mapped column of strings (or of JSON values), indexed like a
+  list. Missing values read as None.
+  """
+
+  def __init__(self, offsets, data, missing, kind):
+    self.offsets = offsets
+    self.data = data
+    self.missing = missing
+    self.kind = kind
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(len(self)))]
+
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("Row {} out of range".format(i))
+    if self.missing is not None and self.missing[i]:
+      return None
+
+    text = self.data[int(self.offsets[i]):int(self.offsets[i + 1])].tostring()
+    if self.kind == 'json':
+      return json.loads(text)
+    return text.decode('utf-8')
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
+
+def memmap(path, dtype, shape):
+  if shape[0] == 0:
+    return numpy.zeros(shape, dtype=dtype)
+  return numpy.memmap(path, dtype=dtype, mode='w+', shape=shape)
+
+def build(path, fields, records):
+  """
+  Writes the columns of +fields+ for the file at +path+. Calling +records+
+  must return an iterator over its parsed records; it is called twice.
+  """
+
+  kinds = dict((field, None) for field in fields)
+  rows = 0
+  for record in records():
+    rows += 1
+    for field in fields:
+      value = lookup(record, field)
+      if value is not MISSING:
+        kinds[field] = merge(kinds[field], kind_of(value))
+
+  directory = path + '.columns'
+  work = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.columns')
+  try:
+    columns = {}
+    for field in fields:
+      name = os.path.join(work, urllib.quote(field, safe=''))
+      kind = kinds[field] or 'float'
+      missing = numpy.zeros(rows, dtype=bool)
+      if kind in DTYPES:
+        columns[field] = (kind, missing,
+                          memmap(name + '.values', DTYPES[kind], (rows,)))
+      else:
+        columns[field] = (kind, missing,
+                          numpy.zeros(rows + 1, dtype=numpy.uint64),
+                          open(name + '.bytes', 'wb'))
+
+    row = -1
+    for row, record in enumerate(records()):
+      if row >= rows:
+        break
+      for field in fields:
+        kind, missing, values = columns[field][:3]
+        value = lookup(record, field)
+
+        if kind in DTYPES:
+          if value is MISSING:
+            missing[row] = True
+            if kind == 'float':
+              values[row] = numpy.nan
+          else:
+            values[row] = value
+        else:
+          data = columns[field][3]
+          if value is MISSING:
+            missing[row] = True
+          else:
+            if kind == 'json':
+              value = json.dumps(value)
+            elif isinstance(value, unicode):
+              value = value.encode('utf-8')
+            data.write(value)
+          values[row + 1] = data.tell()
+
+    if row + 1 != rows:
+      raise IOError("{} changed while its columns were written".format(path))
+
+    try:
+      os.mkdir(directory)
+    except OSError:
+      if not os.path.isdir(directory):
+        raise
+
+    stamp = source(path)
+    for field in fields:
+      column = columns[field]
+      name = os.path.join(work, urllib.quote(field, safe=''))
+      if column[0] in DTYPES:
+        if rows:
+          column[2].flush()
+        else:
+          open(name + '.values', 'wb').close()
+        files = ['.values']
+      else:
+        column[3].close()
+        open(name + '.offsets', 'wb').write(column[2].tostring())
+        files = ['.offsets', '.bytes']
+
+      if column[1].any():
+        open(name + '.missing', 'wb').write(column[1].tostring())
+        files.append('.missing')
+      elif os.path.exists(column_name(path, field) + '.missing'):
+        os.remove(column_name(path, field) + '.missing')
+
+      open(name + '.meta', 'w').write(json.dumps(
+        {'kind': column[0], 'rows': rows, 'source': stamp}))
+      for suffix in files + ['.meta']:
+        os.rename(name + suffix, column_name(path, field) + suffix)
+  finally:
+    shutil.rmtree(work, ignore_errors=True)
+
+def load(path, field):
+  """
+  Returns the column of +field+ for the file at +path+, memory-mapped, or
+  None if it has not been built for the current version of the file.
+  """
+
+  name = column_name(path, field)
+  try:
+    meta = json.load(open(name + '.meta'))
+  except (IOError, ValueError):
+    return None
+  if meta['source'] != source(path):
+    return None
+
+  kind = meta['kind']
+
+  def read(suffix, dtype):
+    if not os.path.getsize(name + suffix):
+      return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(name + suffix, dtype=dtype, mode='r')
+
+  missing = None
+  if os.path.exists(name + '.missing'):
+    missing = read('.missing', bool)
+
+  if kind in DTYPES:
+    values = read('.values', DTYPES[kind])
+    if missing is not None:
+      return numpy.ma.masked_array(values, mask=missing)
+    return values
+
+  return StringColumn(read('.offsets', numpy.uint64),
+                      read('.bytes', numpy.uint8), missing, kind)
@@ -0,0 +1,69 @@
+"""
+Process-wide pool of S3 connections and buckets.
+
+boto connections must not be shared between threads, so each thread gets
+its own connection per set of credentials, which is then reused for every
+request made from that thread. Bucket objects are kept as well, so that
+get_bucket() only costs a round trip the first time. After a fork, the
+child process drops the inherited connections and reconnects on demand.
+"""
+
+import os
+import threading
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+_local = threading.local()
+
+def _state():
+  """
+  Returns the (connections, buckets) dictionaries of the calling thread,
+  discarding them if they were inherited across a fork.
+  """
+
+  if getattr(_local, 'pid', None) != os.getpid():
+    _local.pid = os.getpid()
+    _local.connections = {}
+    _local.buckets = {}
+  return _local.connections, _local.buckets
+
+def connection(aws_access_key_id = None, aws_secret_access_key = None):
+  """
+  Returns the calling thread's S3 connection for the given credentials.
+  Without credentials, boto looks them up in the environment.
+  """
+
+  connections, _ = _state()
+  key = (aws_access_key_id, aws_secret_access_key)
+
+  if key not in connections:
+    connections[key] = S3Connection(
+      aws_access_key_id = aws_access_key_id,
+      aws_secret_access_key = aws_secret_access_key,
+      calling_format = OrdinaryCallingFormat(),
+    )
+  return connections[key]
+
+def bucket(name, validate = True, aws_access_key_id = None,
+           aws_secret_access_key = None):
+  """
+  Returns the calling thread's bucket object with the given name. If
+  +validate+ is set, the bucket's existence is checked the first time it is
+  requested.
+  """
+
+  _, buckets = _state()
+  key = (name, aws_access_key_id, aws_secret_access_key)
+
+  if key not in buckets or (validate and not buckets[key][1]):
+    conn = connection(aws_access_key_id, aws_secret_access_key)
+    buckets[key] = (conn.get_bucket(name, validate = validate), validate)
+  return buckets[key][0]
+
+def reset():
+  """
+  Drops the calling thread's connections, e.g. after a network error left
+  one of them in a bad state.
+  """
+
+  _local.pid = None
+  _state()
@@ -1,14 +1,33 @@
 import config
 import json
+import copy
 try:
   import cPickle as pickle
 except ImportError:
   import pickle
 from cache import Cache
 from s3iterable import S3Iterable
+import parallel
 import csv
 import datetime
 
+def parse_crimes(lines):
+  """
+  Yields the (day, latitude, longitude, crime_type) of each valid row.
+  """
+
+  for row in csv.reader(lines):
+    try:
+      date, lat, lon, crime_type = row
+      
+      day = datetime.datetime.strptime(date, "%m/%d/%Y %I:%M:%S %p")
+      latitude = float(lat)
+      longitude = float(lon)
+      
+      yield day, latitude, longitude, crime_type
+    except ValueError:
+      pass
+
 class Crime(S3Iterable):
   def __init__(self):
     super(Crime, self).__init__() 
@@ -22,47 +41,42 @@ class Crime(S3Iterable):
     Returns all crime types.
     """
 
-    fp = self.cache.directhandle(self.bucketname, "type_file.zip",
-           decompress="unzip")
-    return pickle.load(fp)
+    return copy.copy(self.cache.sidefile(self.bucketname, "type_file.zip",
+             "pickle", pickle.load, decompress="unzip"))
 
   def get_crime_counts(self):
     """
     Returns the numbers of each type of crime.
     """
 
-    fp = self.cache.directhandle(self.bucketname, "count_file.zip",
-           decompress="unzip")
-    return pickle.load(fp)
+    return copy.copy(self.cache.sidefile(self.bucketname, "count_file.zip",
+             "pickle", pickle.load, decompress="unzip"))
 
   def get_region_list(self):
     """
     Iterates over all regions in the dataset.
     """
 
-    fp = self.cache.directhandle(self.bucketname, "center_file.zip",
-           decompress="unzip")
-    return pickle.load(fp)
+    return copy.copy(self.cache.sidefile(self.bucketname, "center_file.zip",
+             "pickle", pickle.load, decompress="unzip"))
 
-  def iter(self):
+  def iter(self, processes=None, ordered=True):
     """
-    Iterates over all crimes in the dataset.
+    Iterates over all crimes in the dataset. With +processes+ set, rows are
+    parsed in chunks on that many worker processes, in file order unless
+    +ordered+ is false.
     """
 
     fp = self.cache.directhandle(self.bucketname, "raw_file.zip",
-           decompress="unzip")
+           decompress="unzip", stream=self.stream)
+
+    if processes:
+      rows = parallel.imap_lines(parse_crimes, fp, processes, ordered)
+    else:
+      rows = parse_crimes(fp)
 
-    for row in csv.reader(fp):
-      try:
-        date, lat, lon, crime_type = row
-        
-        day = datetime.datetime.strptime(date, "%m/%d/%Y %I:%M:%S %p")
-        latitude = float(lat)
-        longitude = float(lon)
-        
-        yield day, latitude, longitude, crime_type
-      except ValueError:
-        pass
+    for row in rows:
+      yield row
 
   """
   def metadata(self):
@@ -0,0 +1,128 @@
+"""
+Cached image features for TinyImages.
+
+Features are computed one part (3400 images) at a time and stored next to
+the pixel parts in the cache as float32 files, which are memory-mapped
+when they are read back. Missing parts are computed in a process pool.
+"""
+
+import os
+import tempfile
+import multiprocessing
+import numpy
+from cache import Cache, storage_name
+from parts import read_part
+
+def gist(images):
+  """
+  Computes the 960-dimensional color GIST descriptor of each (3072,)
+  record in +images+.
+  """
+
+  import leargist
+  from PIL import Image
+
+  o = numpy.empty((len(images), 960), dtype=numpy.float32)
+  for i, record in enumerate(images):
+    o[i] = leargist.color_gist(
+      Image.fromarray(record.reshape(32, 32, 3, order="F")))
+  return o
+
+# Feature kinds, with their dimension and the function computing them.
+KINDS = {
+  'gist': (960, gist),
+}
+
+def feature_name(kind, block):
+  return 'features-{}/{}.f32'.format(kind, block)
+
+def compute_block(args):
+  """
+  Computes the features of one part and writes them to the cache. Runs in
+  a worker process; returns the path of the feature file.
+  """
+
+  bucketname, kind, block = args
+  cache = Cache()
+  features = KINDS[kind][1](read_part(cache, bucketname, block))
+
+  path = storage_name(cache.path, feature_name(kind, block), bucketname)
+  handle, temp = tempfile.mkstemp(dir=cache.path, prefix='.features')
+  os.write(handle, features.astype(numpy.float32).tostring())
+  os.close(handle)
+  os.rename(temp, path)
+  return path
+
+class FeatureStore(object):
+  """
+  The features of one kind for the images of +dataset+.
+  """
+
+  def __init__(self, dataset, kind):
+    if kind not in KINDS:
+      raise ValueError("Unknown feature kind {!r} (must be one of {!r})".
+        format(kind, sorted(KINDS)))
+
+    self.dataset = dataset
+    self.cache = dataset.cache
+    self.kind = kind
+    self.dimension = KINDS[kind][0]
+
+  def path(self, block):
+    return storage_name(self.cache.path, feature_name(self.kind, block),
+                        self.dataset.bucketname)
+
+  def ensure(self, blocks, processes = None):
+    """
+    Computes the features of the given parts that are not cached yet, one
+    part per task on a pool of +processes+ workers.
+    """
+
+    missing = [(self.dataset.bucketname, self.kind, block)
+               for block in sorted(set(blocks))
+               if not os.path.isfile(self.path(block))]
+    if not missing:
+      return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+      for path in pool.imap_unordered(compute_block, missing):
+        self.cache.record(path)
+    finally:
+      pool.close()
+      pool.join()
+
+  def part(self, block):
+    """
+    Returns the features of part +block+ as a memory-mapped (images,
+    dimension) float32 array, computing them again if they were evicted.
+    """
+
+    path = self.path(block)
+    if not os.path.isfile(path):
+      # Evicted by a download since it was computed.
+      self.ensure([block])
+    self.cache.index.touch(os.path.basename(path))
+    if os.path.getsize(path) == 0:
+      return numpy.zeros((0, self.dimension), dtype=numpy.float32)
+    return numpy.memmap(path, dtype=numpy.float32, mode='r').reshape(
+             -1, self.dimension)
+
+  def get(self, indexes, processes = None):
+    """
+    Returns the features of the given images as one (N, dimension) float32
+    array, computing the parts that are missing.
+    """
+
+    indexes = numpy.asarray(indexes, dtype=numpy.int64)
+    blocks = indexes // 3400
+    self.ensure(numpy.unique(blocks), processes)
+
+    o = numpy.empty((len(indexes), self.dimension), dtype=numpy.float32)
+    order = numpy.argsort(blocks, kind='mergesort')
+    bounds = numpy.flatnonzero(numpy.diff(blocks[order])) + 1
+    for positions in numpy.split(order, bounds):
+      if len(positions):
+        part = self.part(blocks[positions[0]])
+        o[positions] = part.take(indexes[positions] % 3400, axis=0)
+    return o
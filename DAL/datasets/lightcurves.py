@@ -2,6 +2,7 @@ import urllib2
 import urllib
 import config
 import json
+import copy
 import pickle
 from cache import Cache
 from s3iterable import S3Iterable
@@ -56,12 +57,24 @@ class LightCurves(S3Iterable):
     return result
 
   def examples(self):
-    return json.load(
-      self.cache.directhandle(self.bucketname, "examples.json"))
+    return copy.copy(self.cache.sidefile(self.bucketname, "examples.json",
+                                         "json", json.load))
   
   def example(self):
     return self.examples()
 
+  def ids(self, name):
+    """
+    Returns the ids listed one per line in the file +name+, as a frozenset,
+    along with the number of lines.
+    """
+
+    def read(fp):
+      ids = [int(i) for i in fp]
+      return frozenset(ids), len(ids)
+
+    return self.cache.sidefile(self.bucketname, name, "ids", read)
+
   def prcurve_a(self, ranking):
       """
       Display the precision-recall curve for part A.
@@ -75,27 +88,21 @@ class LightCurves(S3Iterable):
       import pickle
       
       # Change strings into numbers for IDs. 
-      mapping = pickle.load(self.cache.directhandle(self.bucketname,
-                             "mapp.pickle"))
-      as_dict = dict([(y, x) for (x, y) in mapping])
+      as_dict = self.cache.sidefile(self.bucketname, "mapp.pickle",
+        "by-name", lambda fp: dict([(y, x) for (x, y) in pickle.load(fp)]))
       ranking = [as_dict.get(x, None) for x in ranking]
-      as_dict = None
-      mapping = None
       
       # Retrieve IDs from DAL.
-      conf_cand_eb_id = [int(i) for i in
-                             self.cache.directhandle(self.bucketname, 'conf_cand_eb_id.txt')]
-      conf_id = [int(i) for i in self.cache.directhandle(self.bucketname, 'conf_id.txt')]
-      conf_and_cand_id = [int(i) for i in
-                          self.cache.directhandle(self.bucketname, 'conf_and_cand_id.txt')]
-      conf_and_eb_id = [int(i) for i in
-                        self.cache.directhandle(self.bucketname, 'conf_and_eb_id.txt')]
+      conf_cand_eb_id, N_conf_cand_eb = self.ids('conf_cand_eb_id.txt')
+      conf_id, N_conf = self.ids('conf_id.txt')
+      conf_and_cand_id, N_conf_and_cand = self.ids('conf_and_cand_id.txt')
+      conf_and_eb_id, N_conf_and_eb = self.ids('conf_and_eb_id.txt')
       
       # conf + eb
       precision = []
       recall = []
       count = 0.0
-      N = len(conf_and_eb_id)
+      N = N_conf_and_eb
       for i in xrange(len(ranking)):
           ID = ranking[i]
           if ID in conf_and_eb_id:
@@ -119,7 +126,7 @@ class LightCurves(S3Iterable):
       precision = []
       recall = []
       count = 0.0
-      N = len(conf_cand_eb_id)
+      N = N_conf_cand_eb
       for i in xrange(len(ranking)):
           ID = ranking[i]
           if ID in conf_cand_eb_id:
@@ -153,21 +160,15 @@ class LightCurves(S3Iterable):
       import pickle
       
       # Change strings into numbers for IDs. 
-      mapping = pickle.load(self.cache.directhandle(self.bucketname,
-                             "mapp.pickle"))
-      as_dict = dict([(y, x) for (x, y) in mapping])
+      as_dict = self.cache.sidefile(self.bucketname, "mapp.pickle",
+        "by-name", lambda fp: dict([(y, x) for (x, y) in pickle.load(fp)]))
       ranking = [as_dict.get(x, None) for x in ranking]
-      as_dict = None
-      mapping = None
       
       # Retrieve IDs from DAL.
-      conf_cand_eb_id = [int(i) for i in
-                             self.cache.directhandle(self.bucketname, 'conf_cand_eb_id.txt')]
-      conf_id = [int(i) for i in self.cache.directhandle(self.bucketname, 'conf_id.txt')]
-      conf_and_cand_id = [int(i) for i in
-                          self.cache.directhandle(self.bucketname, 'conf_and_cand_id.txt')]
-      conf_and_eb_id = [int(i) for i in
-                        self.cache.directhandle(self.bucketname, 'conf_and_eb_id.txt')]
+      conf_cand_eb_id, N_conf_cand_eb = self.ids('conf_cand_eb_id.txt')
+      conf_id, N_conf = self.ids('conf_id.txt')
+      conf_and_cand_id, N_conf_and_cand = self.ids('conf_and_cand_id.txt')
+      conf_and_eb_id, N_conf_and_eb = self.ids('conf_and_eb_id.txt')
     
       # conf vs eb
       order = [i for i in ranking if i in conf_and_eb_id]
@@ -175,7 +176,7 @@ class LightCurves(S3Iterable):
       recall = []
       count = 0.0
       i = 0.0
-      N = len(conf_id)
+      N = N_conf
       for ID in order:
           i += 1.0
           if ID in conf_id:
@@ -200,7 +201,7 @@ class LightCurves(S3Iterable):
       recall = []
       count = 0.0
       i = 0.0
-      N = len(conf_and_cand_id)
+      N = N_conf_and_cand
       for ID in order:
           i += 1.0
           if ID in conf_and_cand_id:
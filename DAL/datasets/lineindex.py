@@ -0,0 +1,93 @@
+"""
+Line-offset indexes of cached text files.
+
+The index of a file is a flat array of uint64 byte offsets, one for the
+start of each non-blank line, stored next to the file with an ".offsets"
+suffix. Blank lines are left out, matching what S3Iterable.iter yields.
+"""
+
+import os
+import tempfile
+import numpy
+
+# Bytes that str.strip() removes.
+WHITESPACE = numpy.zeros(256, dtype=bool)
+WHITESPACE[[ord(c) for c in ' \t\n\r\x0b\x0c']] = True
+
+def line_offsets(f, chunk_size = 1 << 24):
+  """
+  Returns the offsets of the non-blank lines read from the file +f+.
+  """
+
+  offsets = []
+  position = 0  # file offset of the current chunk
+  start = 0     # file offset of the line being read
+  solid = False # whether that line has any non-whitespace so far
+
+  while True:
+    chunk = f.read(chunk_size)
+    if not chunk:
+      break
+
+    data = numpy.frombuffer(chunk, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data == 10)
+    filled = numpy.cumsum(~WHITESPACE[data])
+
+    if len(ends):
+      # The first line started in an earlier chunk.
+      if solid or filled[ends[0]] > 0:
+        offsets.append(numpy.array([start], dtype=numpy.uint64))
+
+      # Lines that start and end within this chunk.
+      begins, stops = ends[:-1] + 1, ends[1:]
+      solids = filled[stops] - filled[begins - 1] > 0
+      offsets.append((begins[solids] + position).astype(numpy.uint64))
+
+      start = position + ends[-1] + 1
+      solid = bool(filled[-1] - filled[ends[-1]] > 0)
+    else:
+      solid = solid or bool(filled[-1] > 0)
+
+    position += len(chunk)
+
+  if solid:
+    offsets.append(numpy.array([start], dtype=numpy.uint64))
+
+  if not offsets:
+    return numpy.zeros(0, dtype=numpy.uint64)
+  return numpy.concatenate(offsets)
+
+def build(path):
+  """
+  Writes the index of the file at +path+ and returns it.
+  """
+
+  f = open(path, 'rb')
+  try:
+    offsets = line_offsets(f)
+  finally:
+    f.close()
+
+  handle, temp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                  prefix='.offsets')
+  os.write(handle, offsets.tostring())
+  os.close(handle)
+  os.rename(temp, path + '.offsets')
+  return offsets
+
+def load(path):
+  """
+  Returns the index of the file at +path+, memory-mapped, or None if there
+  is no up-to-date index.
+  """
+
+  try:
+    stats = os.stat(path + '.offsets')
+  except OSError:
+    return None
+
+  if stats.st_mtime < os.path.getmtime(path):
+    return None
+  if stats.st_size == 0:
+    return numpy.zeros(0, dtype=numpy.uint64)
+  return numpy.memmap(path + '.offsets', dtype=numpy.uint64, mode='r')
@@ -0,0 +1,134 @@
+"""
+Shuffled minibatch loading for TinyImages.
+"""
+
+import threading
+import Queue
+import numpy
+from parts import read_part
+
+def to_images(batch):
+  """
+  Reshapes (N, 3072) records into a contiguous (N, 32, 32, 3) array, the
+  same layout as reshape(32, 32, 3, order="F") on each record.
+  """
+
+  return numpy.ascontiguousarray(
+    batch.reshape(-1, 3, 32, 32).transpose(0, 3, 2, 1))
+
+class MinibatchLoader(object):
+  """
+  Iterates over shuffled minibatches of (batch_size, 32, 32, 3) images.
+
+  Parts are visited in a random order and read by background threads that
+  stay at most +prefetch+ parts ahead of the consumer. Images are shuffled
+  within a buffer of about +buffer_blocks+ parts, so that every part is read
+  sequentially and only once per epoch while batches still mix images from
+  several parts. Parts are used in the order they were drawn, however many
+  threads read them, so the batches only depend on +seed+.
+  """
+
+  def __init__(self, dataset, batch_size = 128, blocks = None,
+               buffer_blocks = 4, prefetch = 2, threads = 2, epochs = 1,
+               seed = None):
+    self.dataset = dataset
+    self.batch_size = batch_size
+    if blocks is None:
+      blocks = xrange((dataset.img_count + 3399) // 3400)
+    self.blocks = list(blocks)
+    self.buffer_size = buffer_blocks * 3400
+    self.prefetch = prefetch
+    self.threads = threads
+    self.epochs = epochs
+    self.random = numpy.random.RandomState(seed)
+
+  def read_block(self, block):
+    return read_part(self.dataset.cache, self.dataset.bucketname, block)
+
+  def __worker(self, pending, ready, slots, stop):
+    while True:
+      # Hold a slot from taking a part until it is consumed.
+      slots.acquire()
+      if stop.is_set():
+        return
+      try:
+        i, block = pending.get_nowait()
+      except Queue.Empty:
+        slots.release()
+        return
+
+      try:
+        ready.put((i, self.read_block(block), None))
+      except Exception as exc:
+        ready.put((i, None, exc))
+
+  def __blocks(self):
+    """
+    Yields the parts of all epochs in the order they were drawn, whatever
+    the order in which the worker threads finish reading them, so that the
+    minibatches only depend on the seed.
+    """
+
+    pending = Queue.Queue()
+    count = 0
+    for epoch in xrange(self.epochs):
+      for block in self.random.permutation(self.blocks):
+        pending.put((count, block))
+        count += 1
+
+    # Parts are taken in order, so the next one to yield always holds one
+    # of the slots (or is free to take one).
+    ready = Queue.Queue()
+    slots = threading.Semaphore(self.prefetch + self.threads)
+    stop = threading.Event()
+    workers = [threading.Thread(target = self.__worker,
+                                args = (pending, ready, slots, stop))
+               for i in xrange(self.threads)]
+    for worker in workers:
+      worker.daemon = True
+      worker.start()
+
+    try:
+      arrived = {}
+      for i in xrange(count):
+        while i not in arrived:
+          j, data, error = ready.get()
+          arrived[j] = (data, error)
+        data, error = arrived.pop(i)
+        slots.release()
+        if error is not None:
+          raise error
+        yield data
+    finally:
+      stop.set()
+      for worker in workers:
+        slots.release()
+
+  def __iter__(self):
+    pool = numpy.zeros((0, 3072), dtype=numpy.uint8)
+    blocks = self.__blocks()
+
+    while True:
+      # Fill the shuffle buffer.
+      parts = [pool]
+      size = len(pool)
+      for data in blocks:
+        parts.append(data)
+        size += len(data)
+        if size >= self.buffer_size:
+          break
+
+      if size == len(pool):
+        break # everything was read
+
+      pool = numpy.concatenate(parts)
+      pool = pool[self.random.permutation(len(pool))]
+
+      # Keep the last partial batch for the next buffer.
+      full = len(pool) // self.batch_size * self.batch_size
+      for start in xrange(0, full, self.batch_size):
+        yield to_images(pool[start:start + self.batch_size])
+      pool = pool[full:]
+
+    if len(pool):
+      yield to_images(pool)
@@ -0,0 +1,102 @@
+"""
+Memoized side files.
+
+Small files that a dataset consults over and over (label lists, id lists,
+pickled lookup tables) are parsed once per process and kept in memory.
+Entries are keyed on the identity of the cached file (its inode, size and
+modification time), so a file that was downloaded again is parsed again. A
+file that was evicted from the cache keeps its entry, since what was parsed
+from it is still valid.
+The least recently used entries are released once the entries are larger
+than the budget; the size of an entry is taken to be the size of the file
+it was parsed from.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+def identity(path):
+  """
+  Returns the (inode, size, mtime) of the file at +path+, or None if it does
+  not exist.
+  """
+
+  try:
+    stats = os.stat(path)
+  except OSError:
+    return None
+  return (stats.st_ino, stats.st_size, stats.st_mtime)
+
+class Memo(object):
+  """
+  A least-recently-used map from (path, key) to the value parsed from that
+  file, holding at most +budget+ bytes worth of files (or any amount if the
+  budget is None).
+  """
+
+  def __init__(self, budget):
+    self.budget = budget
+    self.entries = OrderedDict()
+    self.total = 0
+    self.lock = threading.Lock()
+
+  def __drop(self, name):
+    entry = self.entries.pop(name, None)
+    if entry is not None:
+      self.total -= entry[0][1]
+    return entry
+
+  def get(self, path, key, load, used = None):
+    """
+    Returns the value stored for +key+ of the file at +path+, calling
+    +load+ to produce it (and to download the file, if needed) when there is
+    no value for the current version of the file. +used+, if given, is
+    called when the stored value is returned instead.
+    """
+
+    name = (path, key)
+    current = identity(path)
+    with self.lock:
+      entry = self.__drop(name)
+      hit = entry is not None and current in (None, entry[0])
+      if hit:
+        self.entries[name] = entry
+        self.total += entry[0][1]
+
+    if hit:
+      if used is not None:
+        used()
+      return entry[1]
+
+    value = load()
+    current = identity(path)
+    if current is None:
+      return value
+
+    with self.lock:
+      self.__drop(name)
+      self.entries[name] = (current, value)
+      self.total += current[1]
+      while self.budget is not None and self.total > self.budget and \
+            len(self.entries) > 1:
+        self.__drop(next(iter(self.entries)))
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.total = 0
+
+_memos = {}
+
+def memo(path, budget):
+  """
+  Returns the Memo for the given cache directory, shared by every Cache in
+  this process.
+  """
+
+  path = os.path.abspath(path)
+  if path not in _memos:
+    _memos[path] = Memo(budget)
+  return _memos[path]
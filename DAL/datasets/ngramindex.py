@@ -0,0 +1,256 @@
+"""
+Indexed lookups over Google Ngrams subsets.
+
+Building an index reads a subset once with Ngrams.iter_arrays and turns it
+into sorted, memory-mapped arrays stored as a directory in the cache:
+
+  terms.bytes, terms.offsets   the distinct ngrams, sorted, as one blob
+  starts                       the first row of each term (plus the end)
+  year, match_count,
+  page_count, volume_count     one row per (ngram, year), sorted by term
+                               and then by year
+  by_year                      the row numbers, sorted by year
+  model.npz                    the distinct years and their bounds in by_year
+
+The rows of a term are contiguous, so its time series is a slice once the
+term has been found by binary search, and the rows of a year are a slice of
+by_year.
+"""
+
+import os
+import bisect
+import numpy
+from cachedindex import CachedIndex
+
+COUNTS = ('match_count', 'page_count', 'volume_count')
+
+# One year of the time series of an ngram.
+SERIES_DTYPE = numpy.dtype([('year', numpy.int32), ('match_count', numpy.int64),
+                            ('page_count', numpy.int64),
+                            ('volume_count', numpy.int64)])
+
+class TermList(object):
+  """
+  The sorted terms of an index, as a read-only sequence of strings, so that
+  they can be searched with the bisect module.
+  """
+
+  def __init__(self, data, offsets):
+    self.data = data
+    self.offsets = offsets
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(len(self)))]
+    return self.data[int(self.offsets[i]):int(self.offsets[i + 1])].tostring()
+
+  def find(self, term):
+    """
+    Returns the position of +term+, or None.
+    """
+
+    i = bisect.bisect_left(self, term)
+    if i < len(self) and self[i] == term:
+      return i
+    return None
+
+  def prefixed(self, prefix):
+    """
+    Returns the range of positions of the terms starting with +prefix+.
+    """
+
+    # No UTF-8 text contains the byte 0xff.
+    return (bisect.bisect_left(self, prefix),
+            bisect.bisect_left(self, prefix + '\xff'))
+
+def append(path, array):
+  f = open(path, 'ab')
+  try:
+    array.tofile(f)
+  finally:
+    f.close()
+
+def read(path, dtype, mode = 'r'):
+  if os.path.getsize(path) == 0:
+    return numpy.zeros(0, dtype=dtype)
+  return numpy.memmap(path, dtype=dtype, mode=mode)
+
+def chunks(dataset, subset, chunk_rows):
+  """
+  Yields the rows of +subset+ as (ngrams, counts) pairs of at most
+  +chunk_rows+ rows: a fixed-width string array and an (n, 4) int64 array
+  of years and counts.
+  """
+
+  for rows in dataset.iter_arrays(subset, chunk_rows):
+    yield rows['ngram'], numpy.column_stack(
+      [rows[name].astype(numpy.int64) for name in ('year',) + COUNTS])
+
+class NgramIndex(CachedIndex):
+  """
+  The index of one subset of an Ngrams dataset.
+  """
+
+  def __init__(self, dataset, subset):
+    CachedIndex.__init__(self, dataset, subset + '.ngrams',
+                         'ngram index of {}'.format(subset))
+    self.subset = subset
+
+  def build(self, chunk_rows = 1 << 20):
+    """
+    Reads the subset once, +chunk_rows+ rows at a time, and writes the
+    index. Only the term dictionary and the sort keys are held in memory.
+    """
+
+    with self.building('.ngrams') as work:
+      names = os.path.join(work, 'ids')
+      ids = {}
+      terms = []
+      for chunk_terms, counts in chunks(self.dataset, self.subset,
+                                        chunk_rows):
+        # Number the terms in order of appearance.
+        unique, inverse = numpy.unique(chunk_terms, return_inverse=True)
+        numbers = numpy.empty(len(unique), dtype=numpy.int32)
+        for i, term in enumerate(unique.tolist()):
+          if term not in ids:
+            ids[term] = len(terms)
+            terms.append(term)
+          numbers[i] = ids[term]
+
+        append(names, numbers[inverse])
+        for j, name in enumerate(('year',) + COUNTS):
+          append(os.path.join(work, name + '.unsorted'), counts[:, j])
+      ids = None
+
+      for name in ('ids', 'year.unsorted') + tuple(c + '.unsorted'
+                                                   for c in COUNTS):
+        if not os.path.exists(os.path.join(work, name)):
+          open(os.path.join(work, name), 'wb').close()
+
+      # Rank the terms, then sort the rows by term and year.
+      order = numpy.argsort(numpy.array(terms, dtype=object), kind='mergesort')
+      rank = numpy.empty(len(terms), dtype=numpy.int64)
+      rank[order] = numpy.arange(len(terms))
+
+      years = read(os.path.join(work, 'year.unsorted'), numpy.int64)
+      first = years.min() if len(years) else 0
+      rows = rank[read(names, numpy.int32)]
+      rows = numpy.argsort(rows * (1 << 16) + (years - first),
+                           kind='mergesort')
+
+      sorted_ranks = rank[read(names, numpy.int32)[rows]]
+      starts = numpy.searchsorted(sorted_ranks,
+                                  numpy.arange(len(terms) + 1))
+      sorted_ranks = None
+
+      numpy.asarray(years[rows], dtype=numpy.int16).tofile(
+        os.path.join(work, 'year'))
+      for name in COUNTS:
+        read(os.path.join(work, name + '.unsorted'), numpy.int64)[rows].tofile(
+          os.path.join(work, name))
+
+      by_year = numpy.argsort(years[rows], kind='mergesort')
+      by_year.astype(numpy.int64).tofile(os.path.join(work, 'by_year'))
+      year_values, year_starts = numpy.unique(years[rows][by_year],
+                                              return_index=True)
+      rows = years = None
+
+      # Write the term dictionary in sorted order.
+      offsets = numpy.zeros(len(terms) + 1, dtype=numpy.uint64)
+      f = open(os.path.join(work, 'terms.bytes'), 'wb')
+      try:
+        for i, position in enumerate(order):
+          f.write(terms[position])
+          offsets[i + 1] = f.tell()
+      finally:
+        f.close()
+      offsets.tofile(os.path.join(work, 'terms.offsets'))
+      starts.astype(numpy.uint64).tofile(os.path.join(work, 'starts'))
+
+      for name in ('ids', 'year.unsorted') + tuple(c + '.unsorted'
+                                                   for c in COUNTS):
+        os.remove(os.path.join(work, name))
+
+      numpy.savez(os.path.join(work, 'model.npz'),
+        year_values=year_values,
+        year_bounds=numpy.append(year_starts, len(by_year)))
+
+  def read(self):
+    model = numpy.load(os.path.join(self.path, 'model.npz'))
+    path = lambda name: os.path.join(self.path, name)
+    return dict(
+      terms = TermList(read(path('terms.bytes'), numpy.uint8),
+                       read(path('terms.offsets'), numpy.uint64)),
+      starts = read(path('starts'), numpy.uint64),
+      year = read(path('year'), numpy.int16),
+      by_year = read(path('by_year'), numpy.int64),
+      year_values = model['year_values'],
+      year_bounds = model['year_bounds'],
+      **dict((name, read(path(name), numpy.int64)) for name in COUNTS))
+
+  def series(self, term):
+    """
+    Returns the rows of +term+ as a SERIES_DTYPE array sorted by year.
+    """
+
+    model = self.load()
+    i = model['terms'].find(term)
+    if i is None:
+      return numpy.zeros(0, dtype=SERIES_DTYPE)
+
+    first, last = int(model['starts'][i]), int(model['starts'][i + 1])
+    o = numpy.empty(last - first, dtype=SERIES_DTYPE)
+    o['year'] = model['year'][first:last]
+    for name in COUNTS:
+      o[name] = model[name][first:last]
+    return o
+
+  def year_totals(self, year, by = 'match_count'):
+    """
+    Returns the positions of the terms used in +year+ and their total +by+
+    counts that year.
+    """
+
+    model = self.load()
+    j = numpy.searchsorted(model['year_values'], year)
+    if j == len(model['year_values']) or model['year_values'][j] != year:
+      return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, numpy.int64)
+
+    # Rows of one year are in term order, since the sort was stable.
+    rows = model['by_year'][model['year_bounds'][j]:model['year_bounds'][j+1]]
+    terms = numpy.searchsorted(model['starts'], rows, side='right') - 1
+    counts = model[by][rows]
+
+    bounds = numpy.flatnonzero(
+      numpy.append([True], terms[1:] != terms[:-1]))
+    return terms[bounds], numpy.add.reduceat(counts, bounds)
+
+  def top_k(self, year, k, by = 'match_count'):
+    """
+    Returns the +k+ terms with the highest +by+ count in +year+ as a list
+    of (term, count) pairs, highest first.
+    """
+
+    terms, counts = self.year_totals(year, by)
+    if len(counts) > k:
+      top = counts.argpartition(len(counts) - k)[len(counts) - k:]
+    else:
+      top = numpy.arange(len(counts))
+    top = top[numpy.argsort(-counts[top], kind='mergesort')]
+
+    names = self.load()['terms']
+    return [(names[int(terms[i])], int(counts[i])) for i in top]
+
+  def prefix(self, prefix, limit = None):
+    """
+    Returns the sorted terms starting with +prefix+, at most +limit+ of them.
+    """
+
+    names = self.load()['terms']
+    first, last = names.prefixed(prefix)
+    if limit is not None:
+      last = min(last, first + limit)
+    return names[first:last]
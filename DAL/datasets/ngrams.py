@@ -1,7 +1,10 @@
 import config
+import os
 import json
+import numpy
 from cache import Cache
 from s3iterable import S3Iterable
+from ngramindex import NgramIndex, SERIES_DTYPE, COUNTS
 
 def parsegram(l):
   pieces = l.split('\t')
@@ -11,6 +14,81 @@ def parsegram(l):
   pieces[4] = int(pieces[4].strip())
   return pieces
 
+def ngram_dtype(width):
+  """
+  Returns the dtype of parsed rows whose ngrams are at most +width+ bytes.
+  """
+
+  return numpy.dtype([('ngram', 'S{}'.format(max(width, 1))),
+                      ('year', numpy.int32), ('match_count', numpy.int64),
+                      ('page_count', numpy.int64),
+                      ('volume_count', numpy.int64)])
+
+def spans(size, firsts, lasts):
+  """
+  Returns a mask of the +size+ bytes that fall in one of the disjoint
+  ranges [firsts[i], lasts[i]).
+  """
+
+  edges = numpy.bincount(firsts, minlength=size + 1) - \
+          numpy.bincount(lasts, minlength=size + 1)
+  return numpy.cumsum(edges[:size]) > 0
+
+def parse_block(block):
+  """
+  Parses a string of complete lines into a structured array, like
+  parsegram on each line. Lines that do not have five fields are skipped.
+  """
+
+  data = numpy.frombuffer(block, dtype=numpy.uint8)
+  ends = numpy.flatnonzero(data == 10)
+  starts = numpy.append([0], ends[:-1] + 1)
+
+  # Find the lines with exactly four tabs, and their first tab.
+  tabs = numpy.flatnonzero(data == 9)
+  tab_lines = numpy.searchsorted(ends, tabs)
+  valid = numpy.bincount(tab_lines, minlength=len(ends)) == 4
+  firsts = tabs[valid[tab_lines]][::4]
+
+  # Blank out the ngrams and the invalid lines, so that only the numbers
+  # are left, separated by whitespace.
+  words = spans(len(data), starts[valid], firsts)
+  numbers = data.copy()
+  numbers[words | spans(len(data), starts[~valid], ends[~valid])] = 32
+  numbers = numpy.fromstring(numbers.tostring(), dtype=numpy.int64, sep=' ')
+  starts = starts[valid]
+
+  if len(numbers) != 4 * len(starts):
+    # Some field is not a number; fall back to parsing line by line,
+    # keeping the same lines as above.
+    rows = []
+    for l in block.split('\n'):
+      if l.count('\t') != 4:
+        continue
+      try:
+        rows.append(tuple(parsegram(l)))
+      except ValueError:
+        pass
+    width = max([len(row[0]) for row in rows] or [1])
+    return numpy.array(rows, dtype=ngram_dtype(width))
+
+  # Gather the ngrams into fixed-width strings.
+  lengths = firsts - starts
+  width = max(int(lengths.max()) if len(lengths) else 0, 1)
+  text = numpy.zeros(len(starts) * width, dtype=numpy.uint8)
+  text[numpy.arange(lengths.sum()) + numpy.repeat(
+    numpy.arange(len(starts)) * width - (numpy.cumsum(lengths) - lengths),
+    lengths)] = data[words]
+
+  o = numpy.empty(len(starts), dtype=ngram_dtype(width))
+  o['ngram'] = text.view('S{}'.format(width))
+  numbers = numbers.reshape(-1, 4)
+  o['year'] = numbers[:, 0]
+  o['match_count'] = numbers[:, 1]
+  o['page_count'] = numbers[:, 2]
+  o['volume_count'] = numbers[:, 3]
+  return o
+
 class Ngrams(S3Iterable):
   def __init__(self):
     super(Ngrams, self).__init__() 
@@ -21,3 +99,129 @@ class Ngrams(S3Iterable):
       self.bucketname = self.config['ngrams']['bucket']
     self.parser = parsegram
     self.decompress = "unzip" 
+
+  def iter_arrays(self, subset, chunk_rows=1 << 18, block_size=1 << 24):
+    """
+    Iterates over the rows of +subset+ as structured numpy arrays of at
+    most +chunk_rows+ rows, with fields ngram (fixed-width bytes, as wide as
+    the longest ngram of the chunk), year, match_count, page_count and
+    volume_count. The subset is read +block_size+ bytes at a time and each
+    chunk is parsed with array operations rather than line by line.
+    """
+
+    h = self.cache.directhandle(self.bucketname, subset,
+          decompress=self.decompress, stream=self.stream)
+    try:
+      rest = ''
+      while True:
+        block = h.read(block_size)
+        last = not block
+        block = rest + block
+        if last and block and not block.endswith('\n'):
+          block += '\n'
+
+        # Cut the block after every chunk_rows-th line, and at its end.
+        ends = numpy.flatnonzero(
+          numpy.frombuffer(block, dtype=numpy.uint8) == 10)
+        cuts = list(ends[chunk_rows - 1::chunk_rows] + 1)
+        if last and block and (not cuts or cuts[-1] != len(block)):
+          cuts.append(len(block))
+
+        first = 0
+        for cut in cuts:
+          yield parse_block(block[first:cut])
+          first = cut
+        rest = block[first:]
+
+        if last:
+          break
+    finally:
+      h.close()
+
+  def ngram_index(self, subset):
+    if not hasattr(self, '_ngram_indexes'):
+      self._ngram_indexes = {}
+    if subset not in self._ngram_indexes:
+      self._ngram_indexes[subset] = NgramIndex(self, subset)
+    return self._ngram_indexes[subset]
+
+  def build_index(self, subsets=None, **options):
+    """
+    Builds the ngram index of the given subsets (all of them by default)
+    that are not indexed yet. Options are passed on to NgramIndex.build.
+    """
+
+    if subsets is None:
+      subsets = self.subsets()
+
+    # Keep the indexes built so far while the next subsets are downloaded.
+    pinned = []
+    try:
+      for subset in subsets:
+        index = self.ngram_index(subset)
+        self.cache.pin(os.path.basename(index.path))
+        pinned.append(os.path.basename(index.path))
+        if not index.exists():
+          index.build(**options)
+    finally:
+      for name in pinned:
+        self.cache.unpin(name)
+
+  def __indexes(self, subsets):
+    if subsets is None:
+      subsets = [subset for subset in self.subsets()
+                 if self.ngram_index(subset).exists()]
+      if not subsets:
+        raise ValueError("There is no ngram index; call build_index first.")
+    return [self.ngram_index(subset) for subset in subsets]
+
+  def series(self, word, subsets=None):
+    """
+    Returns the yearly counts of +word+ over the indexed subsets (or the
+    given ones) as a numpy array with fields year, match_count, page_count
+    and volume_count, sorted by year.
+    """
+
+    if isinstance(word, unicode):
+      word = word.encode('utf-8')
+
+    rows = numpy.concatenate([index.series(word)
+                              for index in self.__indexes(subsets)])
+    rows = rows[numpy.argsort(rows['year'], kind='mergesort')]
+    if not len(rows):
+      return rows
+
+    bounds = numpy.flatnonzero(
+      numpy.append([True], rows['year'][1:] != rows['year'][:-1]))
+    o = numpy.empty(len(bounds), dtype=SERIES_DTYPE)
+    o['year'] = rows['year'][bounds]
+    for name in COUNTS:
+      o[name] = numpy.add.reduceat(rows[name], bounds)
+    return o
+
+  def top_k(self, year, k=10, subsets=None, by='match_count'):
+    """
+    Returns the +k+ ngrams with the highest +by+ count (match_count,
+    page_count or volume_count) in +year+, as (ngram, count) pairs. Each
+    subset contributes its own top +k+, so the result is exact as long as
+    an ngram does not occur in several subsets.
+    """
+
+    totals = {}
+    for index in self.__indexes(subsets):
+      for term, count in index.top_k(year, k, by):
+        totals[term] = totals.get(term, 0) + count
+    return sorted(totals.items(), key=lambda item: -item[1])[:k]
+
+  def prefix(self, p, limit=None, subsets=None):
+    """
+    Returns the sorted ngrams starting with +p+, at most +limit+ of them.
+    """
+
+    if isinstance(p, unicode):
+      p = p.encode('utf-8')
+
+    terms = set()
+    for index in self.__indexes(subsets):
+      terms.update(index.prefix(p, limit))
+    return sorted(terms)[:limit]
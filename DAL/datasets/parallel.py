@@ -0,0 +1,102 @@
+"""
+Parallel processing of the lines of a file.
+
+Lines are grouped into chunks of about +chunk_size+ bytes, and each chunk is
+handed to a pool of worker processes, which apply a function to its lines.
+The function is inherited by the workers when they are forked rather than
+pickled, so it may be a closure or a lambda. At most +in_flight+ chunks are
+queued or being processed at a time, which bounds the memory used however
+large the file is.
+"""
+
+import multiprocessing
+import threading
+import Queue
+from collections import deque
+
+# The function applied by the workers of the most recently started pool.
+_work = None
+_starting = threading.Lock()
+
+def chunks(lines, chunk_size):
+  """
+  Groups +lines+ into lists holding about +chunk_size+ bytes each.
+  """
+
+  chunk, size = [], 0
+  for line in lines:
+    chunk.append(line)
+    size += len(line)
+    if size >= chunk_size:
+      yield chunk
+      chunk, size = [], 0
+
+  if chunk:
+    yield chunk
+
+def run_chunk(lines):
+  """
+  Applies the work function to one chunk in a worker process. Returns the
+  list of results and the exception raised, if any.
+  """
+
+  try:
+    return list(_work(lines)), None
+  except Exception as exc:
+    return None, exc
+
+def imap_lines(work, lines, processes = None, ordered = True,
+               chunk_size = 1 << 22, in_flight = None):
+  """
+  Yields the items of +work+(chunk) for every chunk of +lines+, computed on
+  +processes+ workers (all cores by default). With +ordered+ false, chunks
+  are yielded as soon as they are done, which keeps every worker busy even
+  when some chunks are slow.
+  """
+
+  global _work
+
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  if in_flight is None:
+    in_flight = 2 * processes
+
+  with _starting:
+    _work = work
+    pool = multiprocessing.Pool(processes)
+
+  results = deque()
+  done = Queue.Queue()
+
+  def collect():
+    if ordered:
+      items, error = results.popleft().get()
+    else:
+      items, error = done.get()
+    if error is not None:
+      raise error
+    return items
+
+  try:
+    outstanding = 0
+    for chunk in chunks(lines, chunk_size):
+      if ordered:
+        results.append(pool.apply_async(run_chunk, (chunk,)))
+      else:
+        pool.apply_async(run_chunk, (chunk,), callback = done.put)
+      outstanding += 1
+
+      if outstanding >= in_flight:
+        outstanding -= 1
+        for item in collect():
+          yield item
+
+    while outstanding:
+      outstanding -= 1
+      for item in collect():
+        yield item
+
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
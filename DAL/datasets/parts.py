@@ -0,0 +1,33 @@
+"""
+Reading the parts of TinyImages datasets from the cache.
+
+A part is stored in the cache as "<block>.part.restore", a flat file of
+fixed-size records. A trailing partial record, if any, is ignored.
+"""
+
+import numpy
+
+def read_part(cache, bucketname, block, record_size = 3072):
+  """
+  Returns part +block+ as an in-memory (records, +record_size+) uint8
+  array.
+  """
+
+  h = cache.directhandle(bucketname, str(block)+'.part.restore', binary=True)
+  try:
+    data = numpy.fromfile(h, dtype=numpy.uint8)
+  finally:
+    h.close()
+  count = len(data) // record_size
+  return data[:count * record_size].reshape(count, record_size)
+
+def part_array(dataset, block):
+  """
+  Returns part +block+ of +dataset+ as a memory-mapped (records,
+  block_size) uint8 array.
+  """
+
+  data = dataset.cache.mmaphandle(dataset.bucketname,
+           str(block)+'.part.restore')
+  count = len(data) // dataset.block_size
+  return data[:count * dataset.block_size].reshape(count, dataset.block_size)
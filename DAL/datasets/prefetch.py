@@ -0,0 +1,85 @@
+"""
+Read-ahead over the subsets of a dataset.
+
+While one subset is being read, the next ones are downloaded (and
+extracted, unless they are streamed) on background threads, so that
+fetching overlaps with parsing. Subsets that have been fetched but not read
+yet are pinned in the cache, and the read-ahead stops early when they would
+add up to more than the prefetch budget, which keeps it within the cache's
+garbage collection limits.
+"""
+
+import os
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from cache import storage_name, decompress_name
+
+class Prefetcher(object):
+  """
+  Iterates over the names of +subsets+, yielding each one once it is in the
+  cache, while fetching up to +ahead+ of the following ones.
+  """
+
+  def __init__(self, dataset, subsets, ahead = None, budget = None):
+    self.cache = dataset.cache
+    self.bucketname = dataset.bucketname
+    self.decompress = dataset.decompress
+    self.stream = dataset.stream
+    self.subsets = list(subsets)
+    self.ahead = self.cache.prefetch if ahead is None else ahead
+    self.budget = self.cache.prefetch_size if budget is None else budget
+
+  def names(self, subset):
+    """
+    Returns the names of the cache files of +subset+.
+    """
+
+    path = storage_name(self.cache.path, subset, self.bucketname)
+    if self.decompress is None or self.stream:
+      return [os.path.basename(path)]
+    return [os.path.basename(path), os.path.basename(decompress_name(path))]
+
+  def size(self, subset):
+    entry = self.cache.s3entry(self.bucketname, subset)
+    return entry.size if entry is not None else 0
+
+  def fetch(self, subset):
+    self.cache.directhandle(self.bucketname, subset,
+      decompress=self.decompress, stream=self.stream).close()
+
+  def __iter__(self):
+    pool = ThreadPool(max(self.ahead, 1))
+    pending = deque() # (subset, size, result) of the started fetches
+    queued = 0        # bytes started but not yet read
+    started = 0
+
+    try:
+      for i in xrange(len(self.subsets)):
+        # Start fetching the current subset and the next ones.
+        while started < len(self.subsets) and started <= i + self.ahead:
+          subset = self.subsets[started]
+          size = self.size(subset)
+          if started > i and self.budget is not None and \
+             queued + size > self.budget:
+            break
+
+          for name in self.names(subset):
+            self.cache.pin(name)
+          pending.append((subset, size, pool.apply_async(self.fetch,
+                                                         (subset,))))
+          queued += size
+          started += 1
+
+        subset, size, result = pending.popleft()
+        try:
+          result.get()
+          yield subset
+        finally:
+          for name in self.names(subset):
+            self.cache.unpin(name)
+          queued -= size
+    finally:
+      for subset, size, result in pending:
+        for name in self.names(subset):
+          self.cache.unpin(name)
+      pool.close()
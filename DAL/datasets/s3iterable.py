@@ -1,5 +1,89 @@
 import config
+import random
+import bisect
+from collections import defaultdict
 from cache import Cache
+import parallel
+from prefetch import Prefetcher
+
+def align(h, position):
+  """
+  Returns the offset of the first line of +h+ that starts at or after
+  +position+.
+  """
+
+  if position == 0:
+    return 0
+  h.seek(position - 1)
+  h.readline()
+  return h.tell()
+
+def read_lines(h, start, stop, chunk_size = 1 << 20):
+  """
+  Yields the lines of +h+ that start in the byte range [+start+, +stop+),
+  which must begin at the start of a line.
+  """
+
+  try:
+    h.seek(start)
+    remaining = stop - start
+    rest = ''
+    while remaining > 0:
+      chunk = h.read(min(chunk_size, remaining))
+      if not chunk:
+        break
+      remaining -= len(chunk)
+
+      lines = (rest + chunk).split('\n')
+      rest = lines.pop()
+      for line in lines:
+        yield line + '\n'
+
+    if rest:
+      # The last line runs past +stop+.
+      yield rest + h.readline()
+  finally:
+    h.close()
+
+def line_matcher(prefilter):
+  """
+  Returns a function telling whether a raw line passes +prefilter+: a
+  substring the line must contain, a compiled regular expression it must
+  match somewhere, or a function of the line.
+  """
+
+  if prefilter is None or callable(prefilter):
+    return prefilter
+  if isinstance(prefilter, unicode):
+    prefilter = prefilter.encode('utf-8')
+  if isinstance(prefilter, str):
+    return lambda l: prefilter in l
+  return prefilter.search
+
+def parse_lines(lines, parser, predicate = None, skip_blank = True,
+                prefilter = None):
+  """
+  Yields the parsed +lines+ that +predicate+ accepts. Lines that cannot be
+  parsed are skipped, and so are blank lines if +skip_blank+ is set. Lines
+  rejected by the +prefilter+ function are skipped before being parsed.
+  """
+
+  for l in lines:
+    if skip_blank and not l.strip(): # mask blank lines
+      continue
+    if prefilter is not None and not prefilter(l):
+      continue
+
+    if parser is None:
+      j = l
+    else:
+      try:
+        j = parser(l)
+      except:
+        continue
+
+    if predicate is None or predicate(j):
+      yield j
 
 class S3Iterable(object):
   def __init__(self):
@@ -13,61 +97,261 @@ class S3Iterable(object):
     self.cache = Cache()
     self.iterator = iter
     self.decompress = None
+    # Compressed subsets are inflated while iterating rather than extracted.
+    self.stream = True
 
   def subsets(self):
     return [i.key for i in self.cache.s3listcontents(self.bucketname)
             if not i.key.endswith("meta.txt") ]
 
-  def iter(self, subset):
-    h = self.cache.directhandle(self.bucketname, subset, decompress=self.decompress)
-    for l in self.iterator(h):
-      if not l.strip(): # mask blank lines
+  def refresh(self):
+    """
+    Fetches the list of subsets again instead of using the cached listing.
+    """
+
+    self.cache.refreshlisting(self.bucketname)
+
+  def shard_range(self, subset, shard, num_shards):
+    """
+    Returns the byte range [start, stop) of the cached +subset+ holding
+    shard +shard+ of +num_shards+. Shards hold about the same number of
+    records if the subset has a line-offset index, and about the same number
+    of bytes otherwise; either way they only split the file between lines.
+    """
+
+    if not 0 <= shard < num_shards:
+      raise ValueError("Shard {} is not between 0 and {}".format(
+        shard, num_shards - 1))
+
+    h = self.cache.directhandle(self.bucketname, subset,
+          decompress=self.decompress)
+    try:
+      h.seek(0, 2)
+      size = h.tell()
+
+      offsets = self.cache.lineindex(self.bucketname, subset,
+                  decompress=self.decompress, build=False)
+      if offsets is not None:
+        bounds = [len(offsets) * k // num_shards for k in (shard, shard + 1)]
+        return tuple(int(offsets[i]) if i < len(offsets) else size
+                     for i in bounds)
+
+      return tuple(align(h, size * k // num_shards)
+                   for k in (shard, shard + 1))
+    finally:
+      h.close()
+
+  def lines(self, subset, shard=None, num_shards=None):
+    """
+    Returns the lines of +subset+, or only those of one of its shards.
+    Sharding needs random access, so a compressed subset is extracted.
+    """
+
+    if shard is None and num_shards is None:
+      return self.iterator(self.cache.directhandle(self.bucketname, subset,
+               decompress=self.decompress, stream=self.stream))
+    if shard is None or num_shards is None:
+      raise ValueError("Both shard and num_shards must be given")
+
+    start, stop = self.shard_range(subset, shard, num_shards)
+    h = self.cache.directhandle(self.bucketname, subset,
+          decompress=self.decompress)
+    return self.iterator(read_lines(h, start, stop))
+
+  def iter(self, subset, shard=None, num_shards=None, processes=None,
+           ordered=True):
+    """
+    Iterates over the parsed records of +subset+. With +shard+ and
+    +num_shards+, only the records in that shard of the subset are read,
+    so that +num_shards+ workers can split the subset between them.
+
+    With +processes+ set, lines are parsed in chunks on that many worker
+    processes. The records then come back in file order unless +ordered+
+    is false.
+    """
+
+    return self.__parse(subset, shard, num_shards, processes, ordered)
+
+  def iter_subsets(self, subsets=None, ahead=None, budget=None):
+    """
+    Iterates over the parsed records of each of +subsets+ (all of them, in
+    sorted order, by default), downloading up to +ahead+ subsets in the
+    background while the current one is read. The subsets fetched ahead are
+    limited to +budget+ bytes. Both default to the cache configuration.
+    """
+
+    if subsets is None:
+      subsets = sorted(self.subsets())
+    for subset in Prefetcher(self, subsets, ahead, budget):
+      for item in S3Iterable.iter(self, subset):
+        yield item
+
+  def filter(self, subset, f, shard=None, num_shards=None, processes=None,
+             ordered=True, prefilter=None):
+    """
+    Iterates over the parsed records of +subset+ for which +f+ is true. In
+    parallel mode, +f+ is called in the worker processes.
+
+    A +prefilter+ (a substring, a compiled regular expression, or a function
+    of the line) is checked against each raw line first, and lines that fail
+    it are never parsed. It must accept every line that +f+ could accept.
+    """
+
+    return self.__parse(subset, shard, num_shards, processes, ordered,
+                        predicate=f, skip_blank=False,
+                        prefilter=line_matcher(prefilter))
+
+  def __parse(self, subset, shard, num_shards, processes, ordered,
+              predicate=None, skip_blank=True, prefilter=None):
+    lines = self.lines(subset, shard, num_shards)
+    parser = self.parser
+    if not processes:
+      records = parse_lines(lines, parser, predicate, skip_blank, prefilter)
+    else:
+      records = parallel.imap_lines(
+        lambda chunk: parse_lines(chunk, parser, predicate, skip_blank,
+                                  prefilter),
+        lines, processes, ordered)
+
+    for record in records:
+      yield record
+
+  def columns(self, subset, fields):
+    """
+    Returns a dictionary mapping each of +fields+ (such as "text" or
+    "user.id") to a memory-mapped column holding that field of every record
+    of +subset+, in the order iter yields them. The subset is converted the
+    first time a field is requested, and read from disk afterwards.
+    """
+
+    return self.cache.columns(self.bucketname, subset, fields,
+                              lambda: S3Iterable.iter(self, subset))
+
+  def sample(self, subset, k, seed=None):
+    """
+    Returns up to +k+ records of +subset+ drawn uniformly at random without
+    replacement, in random order. Records whose line cannot be parsed are
+    left out, so fewer than +k+ may be returned.
+
+    If the subset has a line-offset index, only the sampled lines are read;
+    otherwise the subset is read once, keeping a reservoir of raw lines
+    that are parsed at the end. With +subset+ None, the sample is drawn from
+    all subsets, weighted by their number of records. Only the subsets that
+    are drawn from are read; the records of a subset without an index are
+    estimated from its size in the bucket listing.
+    """
+
+    random_state = random.Random(seed)
+    if subset is None:
+      return self.__sample_all(k, random_state)
+    return self.__sample_subset(subset, k, random_state)
+
+  def __sample_subset(self, subset, k, random_state):
+    offsets = self.cache.lineindex(self.bucketname, subset,
+                decompress=self.decompress, build=False)
+    if offsets is not None:
+      picks = random_state.sample(xrange(len(offsets)),
+                                  min(k, len(offsets)))
+      return [item for item in
+              S3Iterable.byids(self, [(subset, i) for i in picks])
+              if item is not None]
+
+    # Reservoir sampling over the raw lines.
+    reservoir = []
+    count = 0
+    for l in self.lines(subset):
+      if not l.strip():
         continue
-      
-      if self.parser is None:
-        yield l
-      else:
-        try:
-          parsed = self.parser(l)
-        except:
-          pass
-        else:
-          yield parsed
-
-  def filter(self, subset, f):
-    h = self.cache.directhandle(self.bucketname, subset, decompress=self.decompress)
-    for l in self.iterator(h):
-      if self.parser is None:
-        j = l
+      if count < k:
+        reservoir.append(l)
       else:
-        try:
-          j = self.parser(l)
-        except:
-          continue
-      if f(j):
-        yield j
+        j = random_state.randint(0, count)
+        if j < k:
+          reservoir[j] = l
+      count += 1
+
+    random_state.shuffle(reservoir)
+    return list(parse_lines(reservoir, self.parser))
+
+  def __sample_all(self, k, random_state):
+    subsets = sorted(self.subsets())
+    sizes = []
+    counts = []
+    for subset in subsets:
+      entry = self.cache.s3entry(self.bucketname, subset)
+      sizes.append(entry.size if entry is not None else 0)
+      offsets = self.cache.lineindex(self.bucketname, subset,
+                  decompress=self.decompress, build=False)
+      counts.append(None if offsets is None else len(offsets))
+
+    # Estimate the records of the unindexed subsets from the records per
+    # byte of the indexed ones.
+    indexed = [(n, size) for n, size in zip(counts, sizes) if n is not None]
+    indexed_size = sum(size for n, size in indexed)
+    rate = float(sum(n for n, size in indexed)) / indexed_size \
+           if indexed_size else 1.0
+
+    ends = []
+    total = 0.0
+    for n, size in zip(counts, sizes):
+      total += n if n is not None else size * rate
+      ends.append(total)
+    if not total:
+      return []
+
+    # Split the draws between the subsets, then sample each one drawn from.
+    draws = defaultdict(int)
+    for _ in xrange(k):
+      s = min(bisect.bisect_right(ends, random_state.random() * total),
+              len(subsets) - 1)
+      draws[subsets[s]] += 1
+
+    items = []
+    for subset in sorted(draws):
+      items.extend(self.__sample_subset(subset, draws[subset], random_state))
+    random_state.shuffle(items)
+    return items
 
   def byid(self, index):
-    (subset, i) = index
-    h = self.cache.directhandle(self.bucketname, subset, decompress=self.decompress)
-    c = 0
-    for l in self.iterator(h):
-      if not l.strip(): # mask blank lines
-        continue
+    return S3Iterable.byids(self, [index])[0]
 
-      if self.parser:
-        try:
-          parsed = self.parser(l)
-        except:
-          continue
-      else:
-        parsed = l
-      
-      if c == i:
-        return parsed
-      else:
-        c += 1
-    return None 
+  def byids(self, indexes):
+    """
+    Returns the items at the given (subset, i) indexes, with None for
+    indexes past the end of their subset or whose line cannot be parsed.
+    Blank lines are not counted. Each lookup is a seek and a single parse,
+    using the subset's line-offset index.
+    """
+
+    by_subset = defaultdict(list)
+    for position, (subset, i) in enumerate(indexes):
+      by_subset[subset].append((i, position))
+
+    result = [None] * len(indexes)
+    for subset, items in by_subset.items():
+      h = self.cache.directhandle(self.bucketname, subset,
+            decompress=self.decompress)
+      offsets = self.cache.lineindex(self.bucketname, subset,
+                  decompress=self.decompress)
+      try:
+        # Read in file order.
+        for i, position in sorted(items):
+          if i < 0 or i >= len(offsets):
+            continue
+          h.seek(int(offsets[i]))
+          l = h.readline()
+
+          if self.parser:
+            try:
+              result[position] = self.parser(l)
+            except:
+              pass
+          else:
+            result[position] = l
+      finally:
+        h.close()
+
+    return result
 
   def display(self, items):
     for i in items:
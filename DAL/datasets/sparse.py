@@ -0,0 +1,166 @@
+"""
+Sparse local copies of S3 objects.
+
+Only the blocks that were actually requested are fetched (with S3 Range
+GETs) and written at their offsets into a sparse file. A bitmap sidecar
+records which blocks of the file are present.
+"""
+
+import os
+import tempfile
+
+class SparseFile(object):
+  """
+  A partially downloaded object of +size+ bytes, stored at +path+ with its
+  bitmap in +path+.bitmap. The object is divided into blocks of
+  +block_size+ bytes, each of which is either fully present or missing.
+  """
+
+  def __init__(self, path, size, block_size):
+    self.path = path
+    self.bitmap_path = path + '.bitmap'
+    self.size = size
+    self.block_size = block_size
+    self.blocks = (size + block_size - 1) // block_size
+    self.bitmap = bytearray(self.blocks)
+    self.present = 0
+    self.identity = None # of the bitmap file last loaded or saved
+
+  @classmethod
+  def load(cls, path):
+    """
+    Returns the SparseFile stored at +path+, or None if there is none.
+    """
+
+    if not os.path.isfile(path):
+      return None
+
+    try:
+      f = open(path + '.bitmap', 'rb')
+    except IOError:
+      return None
+
+    try:
+      size, block_size = [int(x) for x in f.readline().split()]
+      result = cls(path, size, block_size)
+      bitmap = bytearray(f.read())
+      result.identity = identity(os.fstat(f.fileno()))
+    finally:
+      f.close()
+
+    if len(bitmap) != result.blocks:
+      return None
+
+    result.bitmap = bitmap
+    result.present = result.blocks - bitmap.count('\0')
+    return result
+
+  def allocate(self):
+    """
+    Creates the (empty) data file if it does not exist yet.
+    """
+
+    if not os.path.isfile(self.path):
+      f = open(self.path, 'wb')
+      f.truncate(self.size)
+      f.close()
+
+  def save(self):
+    """
+    Atomically writes out the bitmap.
+    """
+
+    self.allocate()
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                    prefix='.sparse')
+    os.write(handle, '{} {}\n'.format(self.size, self.block_size))
+    os.write(handle, str(self.bitmap))
+    self.identity = identity(os.fstat(handle))
+    os.close(handle)
+    os.rename(temp, self.bitmap_path)
+
+  def current(self):
+    """
+    Returns true if the bitmap on disk is still the one this copy was
+    loaded from or saved as, rather than missing or rewritten by another
+    process.
+    """
+
+    try:
+      return identity(os.stat(self.bitmap_path)) == self.identity
+    except OSError:
+      return False
+
+  def fraction(self):
+    """
+    Returns the fraction of blocks that are present.
+    """
+
+    return float(self.present) / max(self.blocks, 1)
+
+  def missing(self, spans):
+    """
+    Returns the byte ranges (first, last), inclusive, that must be fetched
+    to cover the given (offset, length) spans. Adjacent missing blocks are
+    coalesced into a single range.
+    """
+
+    wanted = set()
+    for offset, length in spans:
+      first = offset // self.block_size
+      last = min((offset + length - 1) // self.block_size, self.blocks - 1)
+      for block in xrange(first, last + 1):
+        if not self.bitmap[block]:
+          wanted.add(block)
+
+    ranges = []
+    for block in sorted(wanted):
+      if ranges and ranges[-1][1] == block - 1:
+        ranges[-1][1] = block
+      else:
+        ranges.append([block, block])
+
+    return [(first * self.block_size,
+             min((last + 1) * self.block_size, self.size) - 1)
+            for first, last in ranges]
+
+  def write(self, first, data):
+    """
+    Stores +data+, which starts at byte +first+, and marks its blocks as
+    present. The bitmap is only updated on disk by save().
+    """
+
+    self.allocate()
+    f = open(self.path, 'r+b')
+    try:
+      f.seek(first)
+      f.write(data)
+    finally:
+      f.close()
+
+    last = min((first + len(data)) // self.block_size, self.blocks)
+    if first + len(data) == self.size:
+      last = self.blocks
+
+    for block in xrange(first // self.block_size, last):
+      if not self.bitmap[block]:
+        self.bitmap[block] = 1
+        self.present += 1
+
+  def read(self, spans):
+    """
+    Returns the contents of each (offset, length) span.
+    """
+
+    f = open(self.path, 'rb')
+    try:
+      return [read_span(f, offset, length) for offset, length in spans]
+    finally:
+      f.close()
+
+def identity(stats):
+  return (stats.st_ino, stats.st_mtime)
+
+def read_span(f, offset, length):
+  f.seek(offset)
+  return f.read(length)
@@ -2,8 +2,15 @@ import config
 import json
 import math
 import numpy
-from cache import Cache
+import os
+import tempfile
+from collections import defaultdict
+from cache import Cache, storage_name
 from s3iterable import S3Iterable
+from loader import MinibatchLoader, to_images
+from features import FeatureStore, KINDS
+from ann import IVFPQIndex
+from parts import part_array
 
 def block_iterator(block_size):
   def output(f):
@@ -14,7 +21,166 @@ def block_iterator(block_size):
       else:
         break
   return output
+
+def part_names(subset):
+  """
+  Returns the part files named by +subset+: a single name, a list of names,
+  or a (first, end) range of part numbers.
+  """
+
+  if isinstance(subset, basestring):
+    return [subset]
+  elif isinstance(subset, tuple):
+    return [str(block)+'.part.restore' for block in xrange(*subset)]
+  return list(subset)
+
+def read_batches(dataset, subset, batch_size, copy):
+  """
+  Yields (batch_size, block_size) uint8 arrays of consecutive records from
+  the parts named by +subset+ (see part_names). Batches run across part
+  boundaries; only the last one may be shorter. Data is read with
+  readinto() into a single buffer; unless +copy+ is set, every batch is a
+  view of that buffer and is overwritten by the next one.
+  """
+
+  buf = bytearray(batch_size * dataset.block_size)
+  window = memoryview(buf)
+  batch = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(
+            batch_size, dataset.block_size)
+  filled = 0
+
+  for name in part_names(subset):
+    h = dataset.cache.directhandle(dataset.bucketname, name, binary=True)
+    try:
+      while True:
+        count = h.readinto(window[filled:])
+        if not count:
+          break
+        filled += count
+        if filled == len(buf):
+          yield batch.copy() if copy else batch
+          filled = 0
+    finally:
+      h.close()
+
+  rows = filled // dataset.block_size
+  if rows:
+    yield batch[:rows].copy() if copy else batch[:rows]
   
+def read_records(dataset, indexes):
+  """
+  Returns the raw records with the given indexes from +dataset+'s part
+  files. In sparse mode only the requested records are fetched, with the
+  records of each part requested together.
+  """
+
+  if not dataset.sparse:
+    o = []
+    for index in indexes:
+      block = int(math.floor(index / 3400))
+      h = dataset.cache.directhandle(dataset.bucketname,
+            str(block)+'.part.restore', binary=True)
+      offset = (index % 3400) * dataset.block_size
+      h.seek(offset)
+      o.append(h.read(dataset.block_size))
+      h.close()
+    return o
+
+  by_block = defaultdict(list)
+  for position, index in enumerate(indexes):
+    by_block[index // 3400].append((position, index))
+
+  o = [None] * len(indexes)
+  for block, items in by_block.items():
+    spans = [((index % 3400) * dataset.block_size, dataset.block_size)
+             for _, index in items]
+    data = dataset.cache.directrange(dataset.bucketname,
+             str(block)+'.part.restore', spans, dataset.block_size)
+    for (position, _), record in zip(items, data):
+      o[position] = record
+  return o
+
+def gather_records(dataset, indexes):
+  """
+  Returns the records with the given indexes as a single (N, block_size)
+  uint8 array read from memory-mapped parts. A (start, end) range that lies
+  within one part is returned as a view of the mapping, without copying.
+  Otherwise the records of each part are gathered with one take().
+  """
+
+  if isinstance(indexes, tuple):
+    start, end = indexes
+    pieces = []
+    for block in xrange(start // 3400, (max(end, start + 1) - 1) // 3400 + 1):
+      part = part_array(dataset, block)
+      first = max(start - block * 3400, 0)
+      last = min(end - block * 3400, 3400)
+      if last > len(part):
+        raise IndexError("Index {} is past the end of the data".format(
+          block * 3400 + len(part)))
+      pieces.append(part[first:last])
+
+    if len(pieces) == 1:
+      return pieces[0]
+    return numpy.concatenate(pieces)
+
+  indexes = numpy.asarray(indexes, dtype=numpy.int64)
+  out = numpy.empty((len(indexes), dataset.block_size), dtype=numpy.uint8)
+
+  # Visit the parts in order, handling all indexes of a part at once.
+  blocks = indexes // 3400
+  order = numpy.argsort(blocks, kind='mergesort')
+  bounds = numpy.flatnonzero(numpy.diff(blocks[order])) + 1
+  for positions in numpy.split(order, bounds):
+    if len(positions):
+      part = part_array(dataset, blocks[positions[0]])
+      out[positions] = part.take(indexes[positions] % 3400, axis=0)
+  return out
+
+def contact_sheet(items, columns, downscale=1):
+  """
+  Tiles the given (3072,) image records into a single grid image with
+  +columns+ images per row, shrinking each image by the integer factor
+  +downscale+ (which must divide 32). Unused cells are left black.
+  """
+
+  images = to_images(numpy.asarray(items, dtype=numpy.uint8).reshape(-1, 3072))
+  rows = (len(images) + columns - 1) // columns
+  size = 32 // downscale
+
+  grid = numpy.zeros((rows * columns, 32, 32, 3), dtype=numpy.uint8)
+  grid[:len(images)] = images
+  if downscale > 1:
+    grid = grid.reshape(-1, size, downscale, size, downscale, 3).mean(
+             axis=(2, 4)).astype(numpy.uint8)
+
+  return grid.reshape(rows, columns, size, size, 3).transpose(
+           0, 2, 1, 3, 4).reshape(rows * size, columns * size, 3)
+
+# Layout of one 768-byte TinyMetaData record, as written by the Tiny Images
+# toolbox. Strings are padded with spaces.
+META_DTYPE = numpy.dtype([
+  ('keyword', 'S80'),
+  ('filename', 'S95'),
+  ('width', '<i2'),
+  ('height', '<i2'),
+  ('color', 'S1'),
+  ('date', 'S32'),
+  ('engine', 'S10'),
+  ('thumb_url', 'S200'),
+  ('source_url', 'S328'),
+  ('page', '<i4'),
+  ('page_index', '<i4'),
+  ('engine_index', '<i2'),
+  ('overall_index', '<i4'),
+  ('label', '<i2'),
+  ('flags', '<i2'),
+])
+
+# One run of consecutive images sharing a (lowercased) keyword.
+KEYWORD_INDEX_DTYPE = numpy.dtype([('keyword', 'S80'), ('first', '<i8'),
+                                   ('count', '<i8')])
+
 # "meta-bucket": "ml-tinyimages-metadata"
 class TinyMetaData(S3Iterable):
   def __init__(self):
@@ -29,23 +195,43 @@ class TinyMetaData(S3Iterable):
     self.parser = None
     self.block_size = 768
     self.iterator = block_iterator(self.block_size)
+    self.sparse = self.config['tinyimages'].get('sparse', False)
     
   def byid(self, index):
     if index < 0 or index > self.img_count:
       return numpy.fromstring("", dtype='uint8')
     
-    block = int(math.floor(index / 3400))
-    h = self.cache.directhandle(self.bucketname, str(block)+'.part.restore',binary=True)
-    offset = (index % 3400) * self.block_size
-    h.seek(offset)
-    o = h.read(self.block_size) 
-    h.close()
-    return numpy.fromstring(o, dtype='uint8')
+    return numpy.fromstring(read_records(self, [index])[0], dtype='uint8')
 
   def keyword(self, index):
     d = self.byid(index)
     return d[:80].tostring().strip()
 
+  def iter_batches(self, subset, batch_size=3400, copy=True):
+    """
+    Iterates over the metadata records of the given parts in (batch_size,
+    768) uint8 arrays. See read_batches.
+    """
+
+    return read_batches(self, subset, batch_size, copy)
+
+  def records(self, indexes):
+    """
+    Decodes the metadata of the given images into a record array of
+    META_DTYPE. +indexes+ is a list of indices or a (start, end) pair.
+    """
+
+    data = numpy.ascontiguousarray(gather_records(self, indexes))
+    return data.view(META_DTYPE)[:, 0].view(numpy.recarray)
+
+  def part_records(self, block):
+    """
+    Decodes all of the metadata in part +block+ into a record array of
+    META_DTYPE, backed by the memory-mapped part file.
+    """
+
+    return part_array(self, block).view(META_DTYPE)[:, 0].view(numpy.recarray)
+
 class TinyImages(S3Iterable):
   def __init__(self):
     super(TinyImages, self).__init__() 
@@ -60,8 +246,25 @@ class TinyImages(S3Iterable):
     self.block_size = 3072
     self.iterator = block_iterator(self.block_size)
     self.metadata = TinyMetaData()
+    self.sparse = self.config['tinyimages'].get('sparse', False)
+    self.mmap = self.config['tinyimages'].get('mmap', False)
   
-  def search(self, keyword, limit):
+  def search(self, keyword, limit, prefix=False):
+    """
+    Returns up to +limit+ indices of images tagged with +keyword+, or None if
+    there are none. Once build_keyword_index() has been run, this is a
+    lookup in the keyword index, matching regardless of case, or matching
+    every keyword that starts with +keyword+ if +prefix+ is set. Otherwise
+    the sorted metadata is binary-searched.
+    """
+
+    index = self.keyword_index()
+    if index is not None:
+      return self.__search_index(index, keyword, limit, prefix)
+    if prefix:
+      raise ValueError("Prefix searches need the keyword index; "
+                       "run build_keyword_index() first.")
+
     h = self.img_count
     l = 0
     while (h > l):
@@ -89,52 +292,249 @@ class TinyImages(S3Iterable):
         return None
     return [-1] 
         
-  def display(self, items):
+  def __search_index(self, index, keyword, limit, prefix):
+    keys = index['keyword']
+    key = keyword.strip().lower()
+    low = keys.searchsorted(key, 'left')
+    if prefix:
+      high = keys.searchsorted(key + '\xff', 'left')
+    else:
+      high = keys.searchsorted(key, 'right')
+    if low == high:
+      return None
+
+    o = []
+    for first, count in zip(index['first'][low:high], index['count'][low:high]):
+      o.extend(xrange(first, first + min(count, limit - len(o))))
+      if len(o) >= limit:
+        break
+    return o
+
+  def keyword_index_path(self):
+    return storage_name(self.cache.path, 'keywords.npy',
+                        self.metadata.bucketname)
+
+  def keyword_index(self):
+    """
+    Returns the keyword index as a memory-mapped array of
+    KEYWORD_INDEX_DTYPE records sorted by keyword, or None if it has not
+    been built.
+    """
+
+    path = self.keyword_index_path()
+    try:
+      mtime = os.path.getmtime(path)
+    except OSError:
+      return None
+
+    if getattr(self, '_keyword_index', (None,))[0] != mtime:
+      self._keyword_index = (mtime, numpy.load(path, mmap_mode='r'))
+    self.cache.index.touch(os.path.basename(path))
+    return self._keyword_index[1]
+
+  def build_keyword_index(self):
+    """
+    Scans the keywords of all metadata parts once and stores the runs of
+    images sharing a keyword in the cache, for use by search(). Keywords
+    are lowercased.
+    """
+
+    runs = []
+    for block in xrange((self.img_count + 3399) // 3400):
+      keys = numpy.char.lower(numpy.char.strip(
+               self.metadata.part_records(block)['keyword']))
+
+      starts = numpy.append([0], numpy.flatnonzero(keys[1:] != keys[:-1]) + 1)
+      counts = numpy.diff(numpy.append(starts, len(keys)))
+      for start, count in zip(starts, counts):
+        first = block * 3400 + start
+        if runs and runs[-1][0] == keys[start] and \
+             runs[-1][1] + runs[-1][2] == first:
+          runs[-1][2] += count
+        else:
+          runs.append([keys[start], first, count])
+
+    index = numpy.array([tuple(r) for r in runs], dtype=KEYWORD_INDEX_DTYPE)
+    index.sort(order=['keyword', 'first'])
+
+    path = self.keyword_index_path()
+    handle, temp = tempfile.mkstemp(dir=self.cache.path, prefix='.keywords')
+    f = os.fdopen(handle, 'wb')
+    try:
+      numpy.save(f, index)
+    finally:
+      f.close()
+    os.rename(temp, path)
+    self.cache.record(path)
+
+  def display(self, items, montage=None, columns=40, downscale=1, page=0,
+              per_page=1000):
+    """
+    Displays the given images in an IPython notebook, +per_page+ at a time
+    starting from page +page+. In montage mode (the default for more than
+    100 images), the page is tiled into one grid of +columns+ images per row,
+    optionally shrunk by +downscale+, and encoded as a single PNG.
+    """
+
     import cStringIO as StringIO
     import base64
     import scipy.misc
     from IPython.core.display import HTML
     from IPython.core.display import display
-    output_html = ""
-    for i in items:
-      t = i.reshape(32,32,3, order="F").copy()
+
+    def encode(t):
       img = scipy.misc.toimage(t) 
       output = StringIO.StringIO()
       img.save(output, format="PNG")
-      output_html += ('<img style="margin:0;display:inline-block" '
-      'src="data:image/png;base64,%s"/>') % base64.b64encode(output.getvalue())
-    display(HTML(output_html)) 
+      return base64.b64encode(output.getvalue())
+
+    total = len(items)
+    items = items[page * per_page:(page + 1) * per_page]
+    if montage is None:
+      montage = len(items) > 100
+
+    output_html = []
+    if total > per_page:
+      output_html.append('<div>Images {} to {} of {} (page {} of {})</div>'.
+        format(page * per_page, page * per_page + len(items), total, page + 1,
+               (total + per_page - 1) // per_page))
+
+    if montage and len(items):
+      output_html.append('<img src="data:image/png;base64,%s"/>' %
+        encode(contact_sheet(items, min(columns, len(items)), downscale)))
+    else:
+      for i in items:
+        t = i.reshape(32,32,3, order="F").copy()
+        output_html.append(('<img style="margin:0;display:inline-block" '
+        'src="data:image/png;base64,%s"/>') % encode(t))
+    display(HTML(''.join(output_html)))
 
   def byid(self, indexes):
+    if self.mmap:
+      # Memory-mapped mode: always returns one (N, 3072) array.
+      if isinstance(indexes, int):
+        self.__check(indexes)
+        return gather_records(self, [indexes])[0]
+      elif isinstance(indexes, tuple):
+        self.__checkall(numpy.arange(indexes[0], indexes[1]))
+      else:
+        indexes = numpy.asarray(indexes, dtype=numpy.int64)
+        self.__checkall(indexes)
+      return gather_records(self, indexes)
+
     if isinstance(indexes, int):
       return self.__byid(indexes) 
     elif isinstance(indexes, tuple):
-      o = []
-      for i in xrange(indexes[0], indexes[1]):
-        o.append(self.__byid(i))
-      return o
+      indexes = xrange(indexes[0], indexes[1])
+
+    indexes = list(indexes)
+    for i in indexes:
+      self.__check(i)
+    return [numpy.fromstring(o, dtype='uint8')
+            for o in read_records(self, indexes)]
+
+  def iter_batches(self, subset, batch_size=3400, copy=True):
+    """
+    Iterates over the images of the given parts in (batch_size, 3072) uint8
+    arrays. +subset+ is a part name, a list of them, or a (first, end) range
+    of part numbers. With +copy+ unset, one buffer is reused for every batch.
+    """
+
+    return read_batches(self, subset, batch_size, copy)
+
+  def features(self, ids, kind="gist", processes=None):
+    """
+    Returns the features of the given images as one (N, dimension) float32
+    array. +ids+ is an index, a (start, end) pair or a list of indices.
+    Features are cached per part; parts that are missing are computed first,
+    using a pool of +processes+ worker processes.
+    """
+
+    if isinstance(ids, int):
+      return self.features([ids], kind, processes)[0]
+    elif isinstance(ids, tuple):
+      ids = numpy.arange(ids[0], ids[1])
     else:
-      o = []
-      for i in indexes:
-        o.append(self.__byid(i))
-      return o
+      ids = numpy.asarray(ids, dtype=numpy.int64)
+    self.__checkall(ids)
+
+    return FeatureStore(self, kind).get(ids, processes)
+
+  def nearest_index(self, kind="pixels"):
+    if not hasattr(self, '_nearest_indexes'):
+      self._nearest_indexes = {}
+    if kind not in self._nearest_indexes:
+      self._nearest_indexes[kind] = IVFPQIndex(self, kind)
+    return self._nearest_indexes[kind]
+
+  def build_nearest_index(self, kind="pixels", blocks=None, **options):
+    """
+    Builds the approximate nearest-neighbour index over the images of the
+    given parts (all of them by default), using raw pixels or a feature kind
+    such as "gist". Options are passed on to IVFPQIndex.build.
+    """
+
+    if blocks is None:
+      blocks = xrange((self.img_count + 3399) // 3400)
+    self.nearest_index(kind).build(blocks, **options)
+
+  def nearest(self, query, k=10, kind="pixels", nprobe=8, distances=False):
+    """
+    Returns the indices of the +k+ images (approximately) most similar to
+    +query+, nearest first. +query+ is an image, or a feature vector of the
+    given kind. Only the +nprobe+ inverted lists nearest to the query are
+    scanned. With +distances+ set, the estimated squared distances are
+    returned as well.
+    """
+
+    query = numpy.asarray(query)
+    if kind != "pixels" and query.size == 3072:
+      # Describe the image with the indexed features.
+      query = KINDS[kind][1](query.reshape(1, 3072).astype(numpy.uint8))[0]
+
+    ids, dist = self.nearest_index(kind).search(query, k, nprobe)
+    if distances:
+      return ids.tolist(), dist.tolist()
+    return ids.tolist()
+
+  def minibatches(self, batch_size=128, blocks=None, **options):
+    """
+    Returns a MinibatchLoader producing shuffled (batch_size, 32, 32, 3)
+    batches of images from the given parts (all of them by default), read
+    ahead on background threads.
+    """
+
+    return MinibatchLoader(self, batch_size, blocks, **options)
 
   def labelled(self, label):
       """
       Returns a list of hand-tagged images.
       """
 
-      fp = self.cache.directhandle(self.bucketname, "labelled-{}.txt".
-        format(label))
-      return json.loads(fp.read())
+      return list(self.cache.sidefile(self.bucketname,
+        "labelled-{}.txt".format(label), "list", json.load))
 
-  def __byid(self, index):
-    if index < 0 or (index > self.img_count and index not in self.labelled("small")):
+  def labelled_set(self, label):
+      """
+      Returns the hand-tagged images as a frozenset, for membership tests.
+      """
+
+      return self.cache.sidefile(self.bucketname,
+        "labelled-{}.txt".format(label), "set",
+        lambda fp: frozenset(json.load(fp)))
+
+  def __check(self, index):
+    if index < 0 or (index > self.img_count and index not in self.labelled_set("small")):
       raise IndexError("Index was %d, but must be between 0 and %d" % (index, self.img_count))
-    block = int(math.floor(index / 3400))
-    h = self.cache.directhandle(self.bucketname, str(block)+'.part.restore',binary=True)
-    offset = (index % 3400) * self.block_size
-    h.seek(offset)
-    o = h.read(self.block_size) 
-    h.close()
-    return numpy.fromstring(o, dtype='uint8')
+
+  def __checkall(self, indexes):
+    bad = indexes[(indexes < 0) | (indexes > self.img_count)]
+    if len(bad):
+      labelled = self.labelled_set("small")
+      for index in bad:
+        if index < 0 or index not in labelled:
+          raise IndexError("Index was %d, but must be between 0 and %d" % (index, self.img_count))
+
+  def __byid(self, index):
+    self.__check(index)
+    return numpy.fromstring(read_records(self, [index])[0], dtype='uint8')
@@ -0,0 +1,117 @@
+"""
+Parallel ranged downloads of large S3 objects.
+
+The object is split into byte ranges which are fetched concurrently on a
+thread pool and written in place into a preallocated file. Ranges that fail
+are retried on their own, so a broken connection only costs one chunk.
+"""
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from boto.s3.key import Key
+import connections
+
+def split_ranges(size, chunk_size):
+  """
+  Returns the inclusive (first, last) byte ranges covering +size+ bytes in
+  pieces of at most +chunk_size+ bytes.
+  """
+
+  return [(start, min(start + chunk_size, size) - 1)
+          for start in xrange(0, size, chunk_size)]
+
+_pools = {}
+
+def thread_pool(size):
+  """
+  Returns a process-wide pool of +size+ threads. Reusing the threads lets
+  them reuse their pooled S3 connections across downloads.
+  """
+
+  key = (os.getpid(), size)
+  if key not in _pools:
+    _pools[key] = ThreadPool(size)
+  return _pools[key]
+
+def preallocate(path, size):
+  """
+  Creates +path+ (or truncates it) with the given size.
+  """
+
+  f = open(path, 'wb')
+  f.truncate(size)
+  f.close()
+
+def get_range(bucket, objname, first, last):
+  """
+  Returns the bytes +first+ through +last+ (inclusive) of the given object.
+  """
+
+  k = Key(bucket)
+  k.key = objname
+  data = k.get_contents_as_string(
+    headers = {'Range': 'bytes={}-{}'.format(first, last)})
+
+  if len(data) != last - first + 1:
+    raise IOError("Short read of {} bytes {}-{}".format(objname, first, last))
+  return data
+
+class RangedDownload(object):
+  """
+  Downloads one S3 object into +path+ using +concurrency+ threads. The
+  +bucket+ function is called from each thread to get that thread's bucket
+  object, since boto connections must not be shared between threads.
+  """
+
+  def __init__(self, bucket, objname, path, size, chunk_size, concurrency,
+               retries = 5):
+    self.bucket = bucket
+    self.objname = objname
+    self.path = path
+    self.size = size
+    self.chunk_size = chunk_size
+    self.concurrency = concurrency
+    self.retries = retries
+
+  def fetch(self, byte_range):
+    """
+    Fetches a single range into the output file. Returns the range if it
+    failed, or None on success.
+    """
+
+    first, last = byte_range
+    try:
+      data = get_range(self.bucket(), self.objname, first, last)
+    except Exception:
+      # Drop the connection, since it may be in a bad state.
+      connections.reset()
+      return byte_range
+
+    f = open(self.path, 'r+b')
+    try:
+      f.seek(first)
+      f.write(data)
+    finally:
+      f.close()
+    return None
+
+  def run(self):
+    """
+    Performs the download, retrying failed ranges. Raises IOError if some
+    ranges could not be fetched.
+    """
+
+    preallocate(self.path, self.size)
+    pending = split_ranges(self.size, self.chunk_size)
+
+    pool = thread_pool(self.concurrency)
+    for attempt in xrange(self.retries + 1):
+      if attempt > 0:
+        time.sleep(1)
+      pending = [r for r in pool.map(self.fetch, pending) if r is not None]
+      if not pending:
+        return
+
+    raise IOError("Could not download {} ranges of {}".format(
+      len(pending), self.objname))
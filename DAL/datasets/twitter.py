@@ -2,6 +2,7 @@ import config
 from cache import Cache
 from s3iterable import S3Iterable
 import json
+import time
 
 class Twitter(S3Iterable):
   def __init__(self):
@@ -22,25 +23,39 @@ class Twitter(S3Iterable):
     Iterates over all subsets of this dataset.
     """
 
-    for subset in sorted(self.subsets()):
-      super(Twitter, self).iter(subset)
+    return self.iter_subsets()
 
   def timed_iterator(self, x):
     """
     Iterates over the given dataset, ensuring that the students read the
-    tweets fast enough.
+    tweets fast enough. Each line is "offset,tweet": a tweet is released
+    +offset+ seconds after the start and is missed if the next one has been
+    released by the time the reader asks for it.
     """
 
     start = time.time()
+    skipped = 0
+    pending = None
     for line in x:
-      skipped = 0
-      while time.time() - start < offset:
-        skipped += 1
-      if skipped != 0:
-        print("WARNING: Your code is too slow, and so missed {} tweets.".
-          format(skipped))
       offset, data = line.split(",", 1)
-      yield data
+      due = start + float(offset)
+
+      if pending is not None:
+        if time.time() >= due:
+          skipped += 1
+        else:
+          if skipped != 0:
+            print("WARNING: Your code is too slow, and so missed {} tweets.".
+              format(skipped))
+            skipped = 0
+          yield pending
+
+      pending = data
+      if due > time.time():
+        time.sleep(due - time.time())
+
+    if pending is not None:
+      yield pending
 
   def byid(self, x):
     """
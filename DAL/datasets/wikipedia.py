@@ -17,13 +17,16 @@ class Wikipedia(S3Iterable):
     return super(Wikipedia, self).byid(
       ("chunk_{}.json".format(id // 1000), id % 1000))
 
+  def byids(self, ids):
+    return super(Wikipedia, self).byids(
+      [("chunk_{}.json".format(id // 1000), id % 1000) for id in ids])
+
   def all_articles(self):
     return xrange(9988)
 
   def iter(self):
-    for subset in sorted(self.subsets()):
-      for item in super(PNAS, self).iter(subset):
-        yield item
+    return self.iter_subsets()
 
   def test_articles(self):
-    return json.load(self.cache.directhandle(self.bucketname, 'testing.id.txt'))
\ No newline at end of file
+    return list(self.cache.sidefile(self.bucketname, 'testing.id.txt', 'list',
+                                    json.load))
\ No newline at end of file
@@ -35,13 +35,15 @@ class WishesLabelled(S3Iterable):
     if config.local():
       raise ValueError("Can only evaluate performance on the cluster.")
     
-    oracle = json.load(self.cache.directhandle(self.bucketname, "oracle.json"))
+    oracle = self.cache.sidefile(self.bucketname, "oracle.json", "by-id",
+      lambda fp: dict((int(key), value)
+                      for key, value in json.load(fp).iteritems()))
     
     correct = 0
     total = 0
     
-    for key, value in oracle.items():
-      if oracle[key] == values.get(int(key), None):
+    for key, value in oracle.iteritems():
+      if value == values.get(key, None):
         correct += 1
       total += 1
     
@@ -25,9 +25,9 @@ import heapq
 import functools
 import sys, json
 from datasets import config
+from datasets import connections
 import hashlib
 import uuid
-import boto
 import marshal
 import pickle
 import mimetypes
@@ -78,8 +78,7 @@ class FileReference(object):
         if running_on_aws():
             location = "blobs/{}".format(uuid.uuid4())
 
-            bucket = boto.connect_s3().get_bucket("ml-checkpoints",
-                       validate = False)
+            bucket = connections.bucket("ml-checkpoints", validate = False)
             bucket.new_key(location).set_contents_from_filename(self._filename)
 
             self._location = ("s3", location)
@@ -96,8 +95,7 @@ class FileReference(object):
         kind, reference = state
 
         if kind == "s3":
-            bucket = boto.connect_s3().get_bucket("ml-checkpoints",
-                       validate = False)
+            bucket = connections.bucket("ml-checkpoints", validate = False)
 
             if bucket.get_key(reference) is None:
                 raise ValueError("FileReference no longer exists.")
@@ -125,7 +123,7 @@ class FileReference(object):
         else:
             self._filename = tempfile.mkstemp()[1]
 
-            bucket = boto.connect_s3().get_bucket("ml-checkpoints")
+            bucket = connections.bucket("ml-checkpoints")
             bucket.new_key(reference).get_contents_to_filename(self._filename)
 
         return self._filename
@@ -156,9 +154,6 @@ def only_once(function):
     if not running_on_aws():
         return function
 
-    # Connect to the proper bucket.
-    bucket = boto.connect_s3().get_bucket("ml-checkpoints")
-
     # Prepare per-user memoization prefix for this function.
     prefix = hashlib.sha1("{}:{}".format(
       os.environ.get('SUBMITTER', '').encode('utf-8'),
@@ -171,6 +166,9 @@ def only_once(function):
         Wrapper for the function to memoize.
         """
 
+        # Connect to the proper bucket.
+        bucket = connections.bucket("ml-checkpoints")
+
         # Set up memoization.
         key_name = "checkpoints/{}".format(
           hashlib.sha1(pickle.dumps((vargs, dargs))).hexdigest())
@@ -215,12 +213,10 @@ def attach_file(file_or_file_name):
         raise ValueError("The file {} does not exist.".format(file_name))
     
     if running_on_aws():
-        import boto
-        
         # Prepare basic key in upload.
         upload_key = str(uuid.uuid4())
         
-        bucket = boto.connect_s3().get_bucket("ml-submissions")
+        bucket = connections.bucket("ml-submissions")
         key = bucket.new_key("attachments/" + upload_key)
         
         # Attempt to guess the MIME-type of this file.